@@ -5,56 +5,206 @@
 # The forumdb module is where the database interface code goes.
 import forumdb
 
+# The forumrender module holds the compiled HTML templates.
+import forumrender
+from forumrender import HTML_HEAD, HTML_FOOT
+
+# The forummetrics module records request counts and latencies.
+import forummetrics
+
+# The forumform module parses submitted forms.
+import forumform
+
 # Other modules used to run a web server.
-import cgi
-from wsgiref.simple_server import make_server
+import argparse
+import collections
+import email.utils
+import os
+import signal
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 from wsgiref import util
+try:
+    import Queue as queue
+    from urllib import quote_plus, quote
+    from urlparse import parse_qs
+except ImportError:
+    import queue
+    from urllib.parse import parse_qs, quote_plus, quote
+
+## Rendered page cache
+# Maps a page's before= cursor ('' for the front page) to the rendered page.
+# Pages after the front one never change, as new posts only go to the front
+# page, so only the front page needs patching when a post is added.
+PAGES = collections.OrderedDict()
+# Number of pages kept besides the front page
+PAGES_CACHED = 10
+PAGES_LOCK = threading.Lock()
+# Bumped on every new post, so a page read before it is not cached after it
+GENERATION = [0]
+# Set when other processes add posts too: their posts never reach this
+# process's PostAdded, so the cached front page is checked against the
+# newest post in the database before it is served.
+REVALIDATE_FRONT_PAGE = False
+
+def RenderPage(posts):
+    '''Render a page from its posts' (cursor, HTML fragment) pairs.
+
+    Returns:
+      A dictionary with the page's 'posts', its full 'html', and the 'etag'
+      and 'modified' (Last-Modified) header values it is served with.
+    '''
+    content = ''.join(fragment for cursor, fragment in posts)
+    page = {'posts': posts,
+            'html': HTML_HEAD + content + OlderLink(posts) + HTML_FOOT}
+    page.update(PageHeaders(posts[0][0] if posts else None))
+    return page
+
+def OlderLink(posts):
+    '''The link to the page after a full page of posts, or ''.'''
+    if len(posts) == forumdb.PAGE_SIZE:
+        return forumrender.Older(cursor=quote(posts[-1][0]))
+    return ''
 
-# HTML template for the forum page
-HTML_WRAP = '''\
-<!DOCTYPE html>
-<html>
-  <head>
-    <title>DB Forum</title>
-    <style>
-      h1, form { text-align: center; }
-      textarea { width: 400px; height: 100px; }
-      div.post { border: 1px solid #999;
-                 padding: 10px 10px;
-		 margin: 10px 20%%; }
-      hr.postbound { width: 50%%; }
-      em.date { color: #999 }
-    </style>
-  </head>
-  <body>
-    <h1>DB Forum</h1>
-    <form method=post action="/post">
-      <div><textarea id="content" name="content"></textarea></div>
-      <div><button id="go" type="submit">Post message</button></div>
-    </form>
-    <!-- post content will go here -->
-%s
-  </body>
-</html>
-'''
-
-# HTML template for an individual comment
-POST = '''\
-    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
-'''
+def PageHeaders(newest):
+    '''The 'etag' and 'modified' values of a page whose newest post has the
+    cursor newest (None for an empty page).'''
+    # A page's posts follow from its newest one, which makes a fine ETag,
+    # and the page last changed when that post was made
+    modified = 0
+    if newest:
+        modified = time.mktime(forumdb.ParseCursor(newest)[0].timetuple())
+    return {'etag': '"%s"' % (newest or 'empty'),
+            'modified': email.utils.formatdate(int(modified), usegmt=True)}
+
+def CachePage(before, page, generation=None):
+    '''Remember a rendered page, evicting the oldest cached page if full.
+
+    A page read from the database at generation is not cached if a post has
+    been added since: it may be missing that post.
+    '''
+    with PAGES_LOCK:
+        if generation is not None and generation != GENERATION[0]:
+            return
+        PAGES[before] = page
+        if len(PAGES) > PAGES_CACHED + 1:
+            for key in PAGES:
+                if key != '':
+                    del PAGES[key]
+                    break
+
+def PostAdded(post):
+    '''Patch the cached front page with a new post (a forumdb listener).'''
+    with PAGES_LOCK:
+        GENERATION[0] += 1
+        front = PAGES.get('')
+        # The front page may have been read after the post was saved, and
+        # cached before this ran; then it has the post already
+        if front is not None and not any(cursor == post['cursor']
+                                         for cursor, _ in front['posts']):
+            posts = [(post['cursor'], post['fragment'])] + front['posts']
+            PAGES[''] = RenderPage(posts[:forumdb.PAGE_SIZE])
+
+forumdb.LISTENERS.append(PostAdded)
+
+def NotModified(env, page):
+    '''Whether the client's conditional headers match its copy of page.'''
+    etags = env.get('HTTP_IF_NONE_MATCH')
+    if etags is not None:
+        etags = [etag.strip() for etag in etags.split(',')]
+        return page['etag'] in etags or '*' in etags
+    since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if since:
+        since = email.utils.parsedate_tz(since)
+        modified = email.utils.parsedate_tz(page['modified'])
+        return (since is not None and
+                email.utils.mktime_tz(modified) <=
+                email.utils.mktime_tz(since))
+    return False
 
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and the previously posted messages, a
+    page at a time; ?before=<cursor> shows the page after that post.
+    Rendered pages are cached, and clients holding a current copy get a 304.
+    Pages not in the cache are streamed: the head goes out first, then the
+    posts as each batch arrives from the database, then the foot.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
+    query = parse_qs(env.get('QUERY_STRING', ''))
+    before = query.get('before', [''])[0]
+    page = PAGES.get(before)
+    if page is not None and not before and REVALIDATE_FRONT_PAGE:
+        newest = page['posts'][0][0] if page['posts'] else None
+        if forumdb.NewestCursor() != newest:
+            page = None
+    batches = None
+    if page is not None:
+        body = [page['html']]
+    else:
+        # get posts from database; the first batch fixes the page's headers
+        generation = GENERATION[0]
+        batches = forumdb.IterPosts(forumdb.PAGE_SIZE, before or None)
+        try:
+            first = next(batches, [])
+        except ValueError:
+            resp('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['Bad Request: unknown page']
+        page = PageHeaders(first[0]['cursor'] if first else None)
+        body = StreamPage(before, first, batches, generation)
     # send results
-    headers = [('Content-type', 'text/html')]
-    resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    headers = [('ETag', page['etag']), ('Last-Modified', page['modified'])]
+    if NotModified(env, page):
+        if batches is not None:
+            batches.close()
+        resp('304 Not Modified', headers)
+        return []
+    resp('200 OK', [('Content-type', 'text/html')] + headers)
+    return body
+
+def StreamPage(before, first, batches, generation):
+    '''Yield a page in pieces, from its first batch of posts and the rest of
+    the batches, then cache it unless a post was added since generation.'''
+    posts = []
+    try:
+        yield HTML_HEAD
+        batch = first
+        while batch:
+            fragments = [(p['cursor'], p['fragment']) for p in batch]
+            posts.extend(fragments)
+            yield ''.join(fragment for cursor, fragment in fragments)
+            batch = next(batches, None)
+        yield OlderLink(posts) + HTML_FOOT
+    finally:
+        batches.close()
+    CachePage(before, RenderPage(posts), None if before else generation)
+
+## Request handler for searching
+def Search(env, resp):
+    '''Search shows the posts matching ?q=, best matches first, a page at a
+    time; &page=<n> shows the n'th page (the first is 1).'''
+    query = parse_qs(env.get('QUERY_STRING', ''))
+    q = query.get('q', [''])[0].strip()
+    try:
+        page = int(query.get('page', ['1'])[0])
+        if page < 1:
+            raise ValueError(page)
+    except ValueError:
+        resp('400 Bad Request', [('Content-type', 'text/plain')])
+        return ['Bad Request: unknown page']
+    # one post more than a page tells whether there is a next page
+    posts = []
+    if q:
+        posts = forumdb.SearchPosts(q, forumdb.PAGE_SIZE + 1,
+                                    (page - 1) * forumdb.PAGE_SIZE)
+    html = HTML_HEAD + forumrender.Searched(q=forumrender.Escape(q))
+    html += ''.join(p['fragment'] for p in posts[:forumdb.PAGE_SIZE])
+    if len(posts) > forumdb.PAGE_SIZE:
+        html += forumrender.MoreResults(q=quote_plus(q), page=str(page + 1))
+    resp('200 OK', [('Content-type', 'text/html')])
+    return [html + HTML_FOOT]
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
@@ -63,19 +213,20 @@ def Post(env, resp):
     The message the user posted is saved in the database, then it sends a 302
     Redirect back to the main page so the user can see their new post.
     '''
-    # Get post content
-    input = env['wsgi.input']
-    length = int(env.get('CONTENT_LENGTH', 0))
-    # If length is zero, post is empty - don't save it.
-    if length > 0:
-        postdata = input.read(length)
-        fields = cgi.parse_qs(postdata)
-        content = fields['content'][0]
-        # If the post is just whitespace, don't save it.
-        content = content.strip()
-        if content:
-            # Save it in the database
-            forumdb.AddPost(content)
+    # Get post content; refuse bodies over forumform's limits unread
+    try:
+        fields = forumform.ReadForm(env)
+    except forumform.TooLarge:
+        resp('413 Request Entity Too Large', [('Content-type', 'text/plain')])
+        return ['Request Entity Too Large']
+    except forumform.BadForm:
+        resp('400 Bad Request', [('Content-type', 'text/plain')])
+        return ['Bad Request: malformed form']
+    # If the post is empty or just whitespace, don't save it.
+    content = fields.get('content', [''])[0].strip()
+    if content:
+        # Save it in the database
+        forumdb.AddPost(content)
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
@@ -85,6 +236,8 @@ def Post(env, resp):
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
+            'metrics': forummetrics.Metrics,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -100,8 +253,108 @@ def Dispatcher(env, resp):
         return ['Not Found: ' + page]
 
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
+## The app the servers run: the Dispatcher, with request metrics
+App = forummetrics.Measure(Dispatcher, DISPATCH)
+
+## Serving modes
+class ForumServer(WSGIServer):
+    '''A WSGIServer with a listen backlog deep enough for many clients.'''
+    request_queue_size = 128
+
+class ThreadPoolServer(ForumServer):
+    '''A ForumServer that hands requests to a fixed pool of worker threads.
+
+    The accepting thread queues each connection; a bounded queue makes it
+    stop accepting, leaving clients in the listen backlog, while every
+    worker is busy.
+    '''
+    def __init__(self, address, handler, workers):
+        ForumServer.__init__(self, address, handler)
+        self.requests = queue.Queue(workers)
+        for i in range(workers):
+            worker = threading.Thread(target=self.Work)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def Work(self):
+        '''Handle queued requests, forever.'''
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+def Stop(signum, frame):
+    '''Turn a termination signal into SystemExit, so finally blocks run.'''
+    raise SystemExit(128 + signum)
+
+def ServePreforked(httpd, workers):
+    '''Fork workers processes that all accept requests on httpd's socket,
+    and wait for them. Stopping the parent, with Ctrl-C or a SIGTERM (a
+    plain kill), stops the workers.'''
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    # Only the parent: the workers keep the default, and die on SIGTERM
+    previous = signal.signal(signal.SIGTERM, Stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+def Serve(port, mode='single', workers=8):
+    '''Serve the forum on port until interrupted.
+
+    Modes:
+      single: one request at a time, in this process.
+      threaded: up to workers requests at a time, on a pool of threads.
+      prefork: workers processes, each serving one request at a time.
+    '''
+    global REVALIDATE_FRONT_PAGE
+    address = ('', port)
+    if mode == 'threaded':
+        forumdb.POOL_SIZE = workers
+        httpd = ThreadPoolServer(address, WSGIRequestHandler, workers)
+    else:
+        httpd = ForumServer(address, WSGIRequestHandler)
+    httpd.set_app(App)
+    print("Serving HTTP on port %d (%s)..." % (port, mode))
+    if mode == 'prefork':
+        REVALIDATE_FRONT_PAGE = True
+        ServePreforked(httpd, workers)
+    else:
+        httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the DB Forum server.')
+    parser.add_argument('--mode', choices=('single', 'threaded', 'prefork'),
+                        default='single',
+                        help='how requests are served (default: single)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads or processes serving requests '
+                             '(default: 8)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: 8000)')
+    args = parser.parse_args()
 
+    # Run this bad server only on localhost!
+    Serve(args.port, args.mode, args.workers)
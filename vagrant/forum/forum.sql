@@ -3,3 +3,19 @@ CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                      id SERIAL );
 
+-- Pages of posts are read newest first with keyset pagination on (time, id)
+CREATE INDEX posts_time_id_idx ON posts (time, id);
+
+
+-- Full-text search: each post's words, kept current by a trigger on insert
+-- and update, and indexed for @@ matches. On an existing forum, run these
+-- statements and then UPDATE posts SET content = content to index old posts.
+ALTER TABLE posts ADD COLUMN search TSVECTOR;
+CREATE TRIGGER posts_search_update BEFORE INSERT OR UPDATE ON posts
+  FOR EACH ROW EXECUTE PROCEDURE
+  tsvector_update_trigger(search, 'pg_catalog.english', content);
+CREATE INDEX posts_search_idx ON posts USING GIN (search);
+
+-- Each post's HTML, escaped and rendered once when the post is saved; posts
+-- saved before this column existed are rendered as they are read
+ALTER TABLE posts ADD COLUMN fragment TEXT;
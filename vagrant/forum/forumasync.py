@@ -0,0 +1,300 @@
+#
+# DB Forum on an asyncio event loop (Python 3.5 or later)
+#
+# Serves the same DISPATCH routes as forum.py over HTTP/1.1 keep-alive
+# connections. Connections are coroutines on one event loop, so thousands
+# of idle clients cost a socket each rather than a thread. The handlers
+# themselves are the blocking WSGI functions in forum.py: each one runs on a
+# small thread pool sharing the pooled psycopg2 connections in forumdb, so
+# the loop never waits on the database. A streamed page is read to the end
+# by the same pool job that ran its handler, before any of it is written, so
+# a slow client never holds a database connection while it reads. Request
+# bodies up to forumform.MAX_BODY are read before the handler runs; larger
+# (multipart) ones are streamed to it from the socket, so an upload is never
+# held in memory whole.
+#
+#   python3 forumasync.py --port 8000 --workers 8
+#
+
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import sys
+from urllib.parse import unquote
+
+import forum
+import forumdb
+import forumform
+
+# Seconds an idle keep-alive connection stays open
+KEEPALIVE_TIMEOUT = 15
+
+# Most header lines read from one request
+MAX_HEADERS = 100
+
+REASONS = {400: 'Bad Request', 411: 'Length Required',
+           413: 'Request Entity Too Large'}
+
+class BadRequest(Exception):
+    '''The client sent something that is not an HTTP request we serve.'''
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+## Reading requests
+async def ReadRequest(reader, port):
+    '''Read one request from reader and build its WSGI environment.
+
+    Returns:
+      The environment, or None if the client closed the connection or left
+      it idle for longer than KEEPALIVE_TIMEOUT.
+
+    Raises:
+      BadRequest: the request was malformed.
+    '''
+    try:
+        line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest(400)
+    path, _, query = target.partition('?')
+    env = {'REQUEST_METHOD': method,
+           'SCRIPT_NAME': '',
+           'PATH_INFO': unquote(path, 'latin-1'),
+           'QUERY_STRING': query,
+           'SERVER_NAME': 'localhost',
+           'SERVER_PORT': str(port),
+           'SERVER_PROTOCOL': version,
+           'wsgi.version': (1, 0),
+           'wsgi.url_scheme': 'http',
+           'wsgi.errors': sys.stderr,
+           'wsgi.multithread': True,
+           'wsgi.multiprocess': False,
+           'wsgi.run_once': False}
+
+    for i in range(MAX_HEADERS + 1):
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep or i == MAX_HEADERS:
+            raise BadRequest(400)
+        key = name.strip().upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        env[key] = value.strip()
+
+    if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+        raise BadRequest(411)
+    try:
+        length = int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise BadRequest(400)
+    if length > forumform.BodyLimit(env):
+        raise BadRequest(413)
+    if length > forumform.MAX_BODY:
+        env['wsgi.input'] = StreamInput(reader, asyncio.get_event_loop(),
+                                        length)
+    else:
+        body = await reader.readexactly(length) if length > 0 else b''
+        env['wsgi.input'] = io.BytesIO(body)
+    return env
+
+class StreamInput(object):
+    '''wsgi.input for a body still on its way from the client.
+
+    The handler's worker thread reads it a piece at a time through the
+    event loop, never past the request's Content-Length. A client that
+    disconnects, or sends nothing for KEEPALIVE_TIMEOUT, ends the body
+    early; the handler sees a short read.
+    '''
+    def __init__(self, reader, loop, length):
+        self.reader = reader
+        self.loop = loop
+        self.left = length
+
+    def read(self, size=-1):
+        if self.left <= 0:
+            return b''
+        if size is None or size < 0 or size > self.left:
+            size = self.left
+        if size == 0:
+            return b''
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(size), KEEPALIVE_TIMEOUT),
+            self.loop)
+        try:
+            data = future.result()
+        except (asyncio.TimeoutError, ConnectionError):
+            data = b''
+        if not data:
+            # Nothing more will come; the connection cannot be reused
+            self.left = -1
+            return b''
+        self.left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        line = b''
+        while not line.endswith(b'\n') and (size < 0 or len(line) < size):
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+def KeepAlive(env):
+    '''Whether the client wants the connection kept open after env.'''
+    connection = env.get('HTTP_CONNECTION', '').lower()
+    if env['SERVER_PROTOCOL'] == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+## Running handlers
+def ReadBody(body):
+    '''Run a streamed body to its end and close it, returning its pieces;
+    whatever database connection it holds goes back to the pool.'''
+    try:
+        return list(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+def CallApp(env):
+    '''Run forum.App on env; return its (status, headers, body).
+
+    A streamed body is read to the end here, in the same job as the handler,
+    so no worker thread goes back to the pool while the task it ran still
+    holds a database connection: the pool has one per worker, and a page
+    waiting for its turn to be read would leave the next handler none.
+    '''
+    response = []
+    def StartResponse(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    body = forum.App(env, StartResponse)
+    if not isinstance(body, (list, tuple)):
+        body = ReadBody(body)
+    return response[0], response[1], body
+
+def Report(loop, env, error):
+    '''Log an exception raised while handling env.'''
+    loop.call_exception_handler({
+        'message': 'Error handling %s %s' % (env['REQUEST_METHOD'],
+                                             env['PATH_INFO']),
+        'exception': error})
+
+def Encode(chunk):
+    '''Handlers yield native strings; the socket wants bytes.'''
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+def Head(status, headers, keep_alive):
+    '''The response's status line and headers.'''
+    lines = ['HTTP/1.1 %s' % status]
+    lines.extend('%s: %s' % header for header in headers)
+    lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def Respond(loop, pool, env, writer, keep_alive):
+    '''Run the handler for env on pool and write its response.
+
+    Every response goes out with a Content-Length. Streamed pages are read
+    to the end by CallApp, even for HEAD, so the handler finishes its work
+    and gives back its database connection before the client is written to:
+    pages are a bounded PAGE_SIZE posts, while the pool holds only as many
+    connections as there are workers.
+
+    Returns:
+      Whether the connection can take another request.
+    '''
+    try:
+        status, headers, body = await loop.run_in_executor(pool, CallApp, env)
+        if getattr(env['wsgi.input'], 'left', 0):
+            # The handler left some of a streamed body unread
+            keep_alive = False
+    except Exception as e:
+        Report(loop, env, e)
+        status, headers, body = ('500 Internal Server Error',
+                                 [('Content-type', 'text/plain')],
+                                 ['Internal Server Error'])
+        keep_alive = False
+    data = b''.join(Encode(chunk) for chunk in body)
+    headers = headers + [('Content-Length', str(len(data)))]
+    writer.write(Head(status, headers, keep_alive))
+    if env['REQUEST_METHOD'] != 'HEAD':
+        writer.write(data)
+    await writer.drain()
+    return keep_alive
+
+## Serving connections
+async def HandleConnection(reader, writer, loop, pool, port):
+    '''Serve requests on one client connection until either side closes.'''
+    try:
+        while True:
+            try:
+                env = await ReadRequest(reader, port)
+            except BadRequest as e:
+                status = '%d %s' % (e.code, REASONS[e.code])
+                writer.write(Head(status, [('Content-Length', '0')], False))
+                break
+            if env is None:
+                break
+            try:
+                keep_alive = await Respond(loop, pool, env, writer,
+                                           KeepAlive(env))
+            except ConnectionError:
+                break
+            except Exception as e:
+                # Writing the response failed; all we can do is hang up
+                Report(loop, env, e)
+                break
+            if not keep_alive:
+                break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        # Disconnected mid-request, or sent a line over the reader's limit
+        pass
+    finally:
+        writer.close()
+
+def Serve(port, workers=8):
+    '''Serve the forum on port until interrupted.'''
+    forumdb.POOL_SIZE = workers
+    pool = concurrent.futures.ThreadPoolExecutor(workers)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def Accept(reader, writer):
+        return HandleConnection(reader, writer, loop, pool, port)
+    server = loop.run_until_complete(
+        asyncio.start_server(Accept, port=port, backlog=1024))
+    print('Serving HTTP on port %d (asyncio)...' % port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        pool.shutdown()
+        loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the DB Forum server on an asyncio event loop.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads running handlers (default: 8)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: 8000)')
+    args = parser.parse_args()
+
+    # Run this bad server only on localhost!
+    Serve(args.port, args.workers)
@@ -2,30 +2,334 @@
 # Database access functions for the web forum.
 # 
 
+import contextlib
+import datetime
+import forumrender
+import os
+import sys
+import threading
 import time
+import traceback
+import psycopg2
+import psycopg2.pool
 
 ## Database connection
-DB = []
+DBNAME = "forum"
+
+## Number of posts shown per page
+PAGE_SIZE = 20
+
+## Number of posts IterPosts fetches from the server at a time
+BATCH_SIZE = 100
+
+## Functions called with each new post (a dict like GetAllPosts returns)
+## once AddPost has saved it. The post is committed by then, so a listener
+## that raises is reported on stderr and AddPost still succeeds.
+LISTENERS = []
+
+def Connect():
+    '''Connect to the forum database.'''
+    return psycopg2.connect("dbname=%s" % DBNAME)
+
+## Connection pools, one per process: connections cannot be shared across
+## fork(), so each pre-forked server process opens its own on first use.
+# Connections each pool holds open; one per thread that uses the database
+POOL_SIZE = 1
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def Pool():
+    '''The connection pool of the current process.'''
+    pid = os.getpid()
+    pool = POOLS.get(pid)
+    if pool is None:
+        with POOLS_LOCK:
+            pool = POOLS.get(pid)
+            if pool is None:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    POOL_SIZE, POOL_SIZE, "dbname=%s" % DBNAME)
+                POOLS[pid] = pool
+    return pool
+
+@contextlib.contextmanager
+def Connection():
+    '''Borrow a pooled connection for a with block. Any transaction left
+    open is rolled back when it goes back to the pool.'''
+    pool = Pool()
+    db = pool.getconn()
+    try:
+        yield db
+    finally:
+        pool.putconn(db)
+
+## Time each thread has spent waiting on the database, for request metrics
+WAITED = threading.local()
+
+def Waited():
+    '''Seconds the calling thread has spent waiting on the database.'''
+    return getattr(WAITED, 'seconds', 0.0)
+
+@contextlib.contextmanager
+def Waiting():
+    '''Count the time a with block takes as time spent on the database.'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        WAITED.seconds = Waited() + time.time() - start
+
+## Pagination cursors: a post's time and id, which order posts uniquely.
+def MakeCursor(time, id):
+    '''Make the opaque cursor for a post, to pass to GetAllPosts(before=).'''
+    return '%s_%d' % (time.isoformat(), id)
+
+def ParseCursor(cursor):
+    '''Split a cursor into its (time, id) parts.
+
+    Raises:
+      ValueError: the cursor was not made by MakeCursor.
+    '''
+    time, sep, id = cursor.rpartition('_')
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(time, format), int(id)
+        except ValueError:
+            pass
+    raise ValueError('Bad cursor: %r' % cursor)
+
+def PostsQuery(limit, before):
+    '''Build the (query, params) for a page of posts, newest first.'''
+    query = "SELECT content, time, id, fragment FROM posts"
+    params = []
+    if before is not None:
+        query += " WHERE (time, id) < (%s, %s)"
+        params.extend(ParseCursor(before))
+    query += " ORDER BY time DESC, id DESC LIMIT %s"
+    params.append(limit)
+    return query, params
+
+def PostDict(row):
+    '''Turn a (content, time, id, fragment) row into a post dictionary.'''
+    content, time, id, fragment = row
+    if fragment is None:
+        # Posts saved before fragments were stored
+        fragment = forumrender.Fragment(content, time)
+    return {'content': str(content), 'time': str(time),
+            'cursor': MakeCursor(time, id), 'fragment': str(fragment)}
 
 ## Get posts from database.
-def GetAllPosts():
-    '''Get all the posts from the database, sorted with the newest first.
+def GetAllPosts(limit=PAGE_SIZE, before=None):
+    '''Get a page of posts from the database, sorted with the newest first.
+
+    Pages are read with keyset pagination on the (time, id) index, so each
+    page costs the same however many posts the forum holds.
+
+    Args:
+      limit: the maximum number of posts to return (None for all of them).
+      before: the 'cursor' of the last post on the previous page; only posts
+        older than that one are returned.
 
     Returns:
       A list of dictionaries, where each dictionary has a 'content' key
-      pointing to the post content, and 'time' key pointing to the time
-      it was posted.
+      pointing to the post content, a 'time' key pointing to the time
+      it was posted, a 'cursor' key to pass as before= to get the page
+      after it, and a 'fragment' key pointing to the post's HTML.
+    '''
+    query, params = PostsQuery(limit, before)
+    with Waiting(), Connection() as db:
+        c = db.cursor()
+        c.execute(query, params)
+        rows = c.fetchall()
+    return [PostDict(row) for row in rows]
+
+def NewestCursor():
+    '''The cursor of the newest post, or None if there are no posts.'''
+    with Waiting(), Connection() as db:
+        c = db.cursor()
+        c.execute("SELECT time, id FROM posts "
+                  "ORDER BY time DESC, id DESC LIMIT 1")
+        row = c.fetchone()
+    return row and MakeCursor(*row)
+
+## Search posts.
+def SearchPosts(terms, limit=PAGE_SIZE, offset=0):
+    '''Get a page of the posts matching a search, best matches first.
+
+    Matches come from the GIN index on the posts' search column, and are
+    ranked by how often and how close together the terms appear.
+
+    Args:
+      terms: the words to search for, as a user typed them.
+      limit: the maximum number of posts to return.
+      offset: the number of better matches to skip, for later pages.
+
+    Returns:
+      A list of dictionaries like those GetAllPosts returns.
+    '''
+    with Waiting(), Connection() as db:
+        c = db.cursor()
+        c.execute("SELECT content, time, id, fragment FROM posts, "
+                  "plainto_tsquery('english', %s) query "
+                  "WHERE search @@ query "
+                  "ORDER BY ts_rank_cd(search, query) DESC, "
+                  "time DESC, id DESC LIMIT %s OFFSET %s",
+                  (terms, limit, offset))
+        rows = c.fetchall()
+    return [PostDict(row) for row in rows]
+
+## Stream posts from database.
+def IterPosts(limit=PAGE_SIZE, before=None, batch=BATCH_SIZE):
+    '''Get the same posts as GetAllPosts, a batch at a time.
+
+    Posts are read through a server-side cursor, so only one batch is held
+    in memory at once. The pooled connection stays checked out until the
+    generator is exhausted or closed.
+
+    Yields:
+      Lists of up to batch post dictionaries, newest first.
+    '''
+    query, params = PostsQuery(limit, before)
+    with Connection() as db:
+        c = db.cursor('posts')
+        try:
+            with Waiting():
+                c.execute(query, params)
+            while True:
+                with Waiting():
+                    rows = c.fetchmany(batch)
+                if not rows:
+                    break
+                yield [PostDict(row) for row in rows]
+        finally:
+            c.close()
+
+## Group commit: AddPost queues each post for a writer thread, one per
+## process, which saves all the posts queued at once with a single INSERT
+## and a single commit, then wakes their callers.
+# Seconds the writer waits for more posts to join a batch
+BATCH_WAIT = 0.005
+# Most posts saved by one INSERT
+BATCH_POSTS = 100
+PENDING = []
+PENDING_READY = threading.Condition()
+WRITERS = {}
+
+def StartWriter():
+    '''Start the current process's writer thread unless it is running.'''
+    pid = os.getpid()
+    with PENDING_READY:
+        if pid not in WRITERS:
+            writer = threading.Thread(target=Writer)
+            writer.daemon = True
+            writer.start()
+            WRITERS[pid] = writer
+
+def Writer():
+    '''Save queued posts in batches, forever.'''
+    db = None
+    while True:
+        with PENDING_READY:
+            while not PENDING:
+                PENDING_READY.wait()
+            deadline = time.time() + BATCH_WAIT
+            while len(PENDING) < BATCH_POSTS:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                PENDING_READY.wait(remaining)
+            batch = PENDING[:BATCH_POSTS]
+            del PENDING[:BATCH_POSTS]
+        try:
+            db = SaveBatch(db, batch)
+        except Exception as e:
+            db = None
+            if len(batch) == 1:
+                batch[0]['error'] = e
+            else:
+                # Save the posts one by one, so only a bad one fails
+                for pending in batch:
+                    try:
+                        db = SaveBatch(db, [pending])
+                    except Exception as e:
+                        db = None
+                        pending['error'] = e
+        for pending in batch:
+            if pending['post'] is not None:
+                Notify(pending['post'])
+            pending['done'].set()
+
+def Notify(post):
+    '''Call each of the LISTENERS with a saved post, reporting any that
+    raise rather than failing the post.'''
+    for listener in LISTENERS:
+        try:
+            listener(post)
+        except Exception:
+            sys.stderr.write('Listener %r failed on post %s:\n'
+                             % (listener, post['cursor']))
+            traceback.print_exc()
+
+def SaveBatch(db, batch):
+    '''Insert and commit the posts of batch, filling in their 'post'.
+
+    Args:
+      db: the writer's connection, or None to open one.
+
+    Returns:
+      The connection, to save the next batch with. On an error it is
+      closed, and the writer opens a new one for the next batch.
     '''
-    posts = [{'content': str(row[1]), 'time': str(row[0])} for row in DB]
-    posts.sort(key=lambda row: row['time'], reverse=True)
-    return posts
+    if db is None or db.closed:
+        db = Connect()
+    try:
+        c = db.cursor()
+        # The time the posts' column default would give them, needed up
+        # front to render their fragments
+        c.execute("SELECT LOCALTIMESTAMP")
+        posted = c.fetchone()[0]
+        fragments = [forumrender.Fragment(pending['content'], posted)
+                     for pending in batch]
+        params = []
+        for pending, fragment in zip(batch, fragments):
+            params.extend((pending['content'], posted, fragment))
+        c.execute("INSERT INTO posts (content, time, fragment) VALUES " +
+                  ", ".join(["(%s, %s, %s)"] * len(batch)) + " RETURNING id",
+                  params)
+        ids = sorted(row[0] for row in c.fetchall())
+        db.commit()
+    except:
+        db.close()
+        raise
+    # Ids are drawn in VALUES order, so sorted they match batch
+    for pending, fragment, id in zip(batch, fragments, ids):
+        pending['post'] = {'content': str(pending['content']),
+                           'time': str(posted),
+                           'cursor': MakeCursor(posted, id),
+                           'fragment': fragment}
+    return db
 
 ## Add a post to the database.
 def AddPost(content):
     '''Add a new post to the database.
 
+    The post is saved by the process's writer thread, together with any
+    other posts added at about the same time; AddPost returns once it has
+    been committed and the LISTENERS have seen it.
+
     Args:
       content: The text content of the new post.
+
+    Returns:
+      The new post, as a dictionary like those GetAllPosts returns.
     '''
-    t = time.strftime('%c', time.localtime())
-    DB.append((t, content))
+    StartWriter()
+    pending = {'content': content, 'done': threading.Event(),
+               'post': None, 'error': None}
+    with PENDING_READY:
+        PENDING.append(pending)
+        PENDING_READY.notify()
+    with Waiting():
+        pending['done'].wait()
+    if pending['error'] is not None:
+        raise pending['error']
+    return pending['post']
@@ -0,0 +1,263 @@
+#
+# Incremental, bounded parsing of form submissions for the web forum
+#
+# ReadForm reads a request body a chunk at a time, into a buffer each
+# thread reuses from request to request, and parses the chunks as they
+# arrive: urlencoded forms as well as multipart/form-data. A body over the
+# size limit is refused from its Content-Length, before any of it is read.
+# Files in a multipart body go to the caller a piece at a time, so a
+# multipart body may be as large as MAX_UPLOAD; only form fields are ever
+# held in memory, and they are bounded by the smaller MAX_BODY.
+#
+
+import re
+import threading
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    from urllib.parse import parse_qsl
+
+# Largest urlencoded body, and largest total of the fields (not files) of
+# a multipart body, in bytes
+MAX_BODY = 64 * 1024
+
+# Largest multipart body, files included, in bytes
+MAX_UPLOAD = 16 * 1024 * 1024
+
+# Bytes read from the client at a time
+CHUNK_SIZE = 8192
+
+# Largest header block of one part of a multipart body
+MAX_PART_HEADERS = 8192
+
+class TooLarge(ValueError):
+    '''The request body is larger than the limit.'''
+
+class BadForm(ValueError):
+    '''The request body is not the form its Content-Type says.'''
+
+def Native(data):
+    '''Turn bytes from the client into a native string.'''
+    if str is bytes:
+        return bytes(data)
+    return bytes(data).decode('utf-8', 'replace')
+
+## Reading the body
+BUFFERS = threading.local()
+
+def IsMultipart(env):
+    '''Whether the request's body is multipart/form-data.'''
+    return env.get('CONTENT_TYPE', '').lower().startswith('multipart/form-data')
+
+def BodyLimit(env, limit=MAX_BODY, upload_limit=MAX_UPLOAD):
+    '''The largest body accepted for the request, by its Content-Type.'''
+    return upload_limit if IsMultipart(env) else limit
+
+def Chunks(env, limit=MAX_BODY):
+    '''Check the request's length, then return an iterator over its body.
+
+    The chunks are read into the calling thread's buffer where wsgi.input
+    supports readinto(), so each one is only valid until the next is read.
+
+    Raises:
+      TooLarge: the Content-Length is over limit.
+      BadForm: the Content-Length is not a number.
+    '''
+    try:
+        length = int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise BadForm('Bad Content-Length: %r' % env.get('CONTENT_LENGTH'))
+    if length > limit:
+        raise TooLarge('Body of %d bytes is over the %d byte limit'
+                       % (length, limit))
+    return ReadChunks(env['wsgi.input'], length)
+
+def ReadChunks(input, length):
+    '''Yield length bytes of input, a chunk at a time.'''
+    view = getattr(BUFFERS, 'view', None)
+    if view is None:
+        view = BUFFERS.view = memoryview(bytearray(CHUNK_SIZE))
+    readinto = getattr(input, 'readinto', None)
+    while length > 0:
+        want = min(length, CHUNK_SIZE)
+        if readinto is not None:
+            chunk = view[:readinto(view[:want]) or 0]
+        else:
+            chunk = input.read(want)
+        if not len(chunk):
+            raise BadForm('Body ended %d bytes early' % length)
+        length -= len(chunk)
+        yield chunk
+
+## Parsing forms
+def ReadForm(env, limit=MAX_BODY, on_file=None,
+             upload_limit=MAX_UPLOAD):
+    '''Read and parse the form submitted in a request's body.
+
+    Args:
+      env: the WSGI environment of the request.
+      limit: the largest urlencoded body, or total of the fields of a
+        multipart body, accepted, in bytes.
+      on_file: for multipart bodies, called as on_file(name, filename,
+        content_type) for each file in the form; it returns an object whose
+        write() is given the file's data, or None to skip the file.
+      upload_limit: the largest multipart body accepted, in bytes.
+
+    Returns:
+      A dictionary mapping each field name to the list of its values.
+
+    Raises:
+      TooLarge: the body, or the fields of a multipart body, are over
+        their limit.
+      BadForm: the body is malformed.
+    '''
+    chunks = Chunks(env, BodyLimit(env, limit, upload_limit))
+    fields = {}
+    content_type = env.get('CONTENT_TYPE', '')
+    if IsMultipart(env):
+        match = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type)
+        if not match:
+            raise BadForm('Multipart body without a boundary')
+        boundary = (match.group(1) or match.group(2)).encode('latin-1')
+        parser = Multipart(boundary, fields, on_file, limit)
+        for chunk in chunks:
+            parser.Feed(chunk)
+        parser.Finish()
+    else:
+        # Urlencoded: parse each run of complete name=value pairs
+        pending = bytearray()
+        for chunk in chunks:
+            pending += chunk
+            end = pending.rfind(b'&')
+            if end >= 0:
+                AddPairs(fields, pending[:end])
+                del pending[:end + 1]
+        AddPairs(fields, pending)
+    return fields
+
+def AddPairs(fields, data):
+    '''Add the name=value pairs of urlencoded data to fields.'''
+    for name, value in parse_qsl(Native(data), keep_blank_values=True):
+        fields.setdefault(name, []).append(value)
+
+## Multipart bodies
+# What a Multipart parser is looking for next
+PREAMBLE, AFTER_DELIMITER, HEADERS, DATA, EPILOGUE = range(5)
+
+class Multipart(object):
+    '''A multipart/form-data parser that is fed the body as it arrives.
+
+    Only what could be the start of the next delimiter is held back between
+    chunks; the rest of each part goes into its field or file at once.
+    Fields, which are held in memory, may total at most limit bytes.
+    '''
+    def __init__(self, boundary, fields, on_file, limit=MAX_BODY):
+        self.delimiter = b'\r\n--' + boundary
+        self.fields = fields
+        self.on_file = on_file
+        self.limit = limit
+        self.field_bytes = 0
+        # The body begins with a delimiter that has no line break before it
+        self.pending = bytearray(b'\r\n')
+        self.state = PREAMBLE
+        self.name = None
+        self.value = None  # the data of a field
+        self.file = None   # where the data of a file goes
+
+    def Feed(self, chunk):
+        '''Parse the next chunk of the body.'''
+        self.pending += chunk
+        while self.Step():
+            pass
+
+    def Finish(self):
+        '''Check the body ended with the closing delimiter.'''
+        if self.state != EPILOGUE:
+            raise BadForm('Multipart body ended inside a part')
+
+    def Step(self):
+        '''Parse as much of the pending data as the state allows; return
+        whether there may be more to parse.'''
+        pending = self.pending
+        if self.state in (PREAMBLE, DATA):
+            i = pending.find(self.delimiter)
+            end = i if i >= 0 else len(pending) - len(self.delimiter) + 1
+            if end > 0:
+                if self.state == DATA:
+                    self.Data(pending[:end])
+                del pending[:end]
+            if i < 0:
+                return False
+            del pending[:len(self.delimiter)]
+            if self.state == DATA:
+                self.EndPart()
+            self.state = AFTER_DELIMITER
+            return True
+        if self.state == AFTER_DELIMITER:
+            if len(pending) < 2:
+                return False
+            if pending[:2] == b'--':
+                self.state = EPILOGUE
+            elif pending[:2] == b'\r\n':
+                del pending[:2]
+                self.state = HEADERS
+                return True
+            else:
+                raise BadForm('Malformed multipart delimiter')
+        if self.state == HEADERS:
+            end = pending.find(b'\r\n\r\n')
+            if end < 0:
+                if len(pending) > MAX_PART_HEADERS:
+                    raise BadForm('Multipart headers too long')
+                return False
+            self.StartPart(Native(pending[:end]))
+            del pending[:end + 4]
+            self.state = DATA
+            return True
+        # EPILOGUE: ignore whatever follows the closing delimiter
+        del pending[:]
+        return False
+
+    def StartPart(self, headers):
+        '''Begin a part, from its header block.'''
+        disposition = {}
+        content_type = 'text/plain'
+        for line in headers.split('\r\n'):
+            header, sep, value = line.partition(':')
+            header = header.strip().lower()
+            if header == 'content-disposition':
+                for key, quoted, bare in re.findall(
+                        r';\s*(\w+)=(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))', value):
+                    disposition[key.lower()] = quoted or bare
+            elif header == 'content-type':
+                content_type = value.strip()
+        if 'name' not in disposition:
+            raise BadForm('Multipart part without a name')
+        self.name = disposition['name']
+        if 'filename' in disposition:
+            self.value = None
+            self.file = None
+            if self.on_file is not None:
+                self.file = self.on_file(self.name, disposition['filename'],
+                                         content_type)
+        else:
+            self.value = bytearray()
+            self.file = None
+
+    def Data(self, data):
+        '''Add data to the current part.'''
+        if self.value is not None:
+            self.field_bytes += len(data)
+            if self.field_bytes > self.limit:
+                raise TooLarge('Form fields over the %d byte limit'
+                               % self.limit)
+            self.value += data
+        elif self.file is not None:
+            self.file.write(bytes(data))
+
+    def EndPart(self):
+        '''Finish the current part.'''
+        if self.value is not None:
+            self.fields.setdefault(self.name, []).append(Native(self.value))
+        self.value = None
+        self.file = None
@@ -0,0 +1,188 @@
+#
+# Test cases for forumform.py; no database needed
+#
+#   python forumform_test.py
+#
+
+import io
+
+import forumform
+from forumform import BadForm, Multipart, ReadForm, TooLarge
+
+BOUNDARY = b'xYzZY'
+
+def Env(body, content_type='application/x-www-form-urlencoded',
+        length=None):
+    '''A WSGI environment for a request with body.'''
+    if length is None:
+        length = len(body)
+    return {'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(length),
+            'wsgi.input': io.BytesIO(body)}
+
+def MultipartBody(*parts):
+    '''A multipart/form-data body of (headers, data) parts.'''
+    body = b''
+    for headers, data in parts:
+        body += b'--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + data
+        body += b'\r\n'
+    return body + b'--' + BOUNDARY + b'--\r\n'
+
+def Field(name, value):
+    '''A form field part.'''
+    return (b'Content-Disposition: form-data; name="' + name + b'"', value)
+
+def File(name, filename, data):
+    '''A file upload part.'''
+    return (b'Content-Disposition: form-data; name="' + name +
+            b'"; filename="' + filename + b'"\r\n'
+            b'Content-Type: application/octet-stream', data)
+
+MULTIPART_TYPE = 'multipart/form-data; boundary=' + BOUNDARY.decode('latin-1')
+
+class Files(object):
+    '''An on_file that keeps each file's name, type and data.'''
+    def __init__(self):
+        self.files = []
+
+    def __call__(self, name, filename, content_type):
+        data = io.BytesIO()
+        self.files.append((name, filename, content_type, data))
+        return data
+
+    def Got(self):
+        '''The (name, filename, content type, data) of each file.'''
+        return [(name, filename, content_type, data.getvalue())
+                for name, filename, content_type, data in self.files]
+
+class Unreadable(object):
+    '''A wsgi.input that fails if it is read at all.'''
+    def read(self, size=-1):
+        raise AssertionError('The body should not have been read.')
+
+def Raises(error, function, *args, **kwargs):
+    '''Whether function(*args, **kwargs) raises error.'''
+    try:
+        function(*args, **kwargs)
+    except error:
+        return True
+    return False
+
+## Test cases
+def TestUrlencoded():
+    fields = ReadForm(Env(b'content=hello+there&tag=a&tag=b&empty='))
+    if fields != {'content': ['hello there'], 'tag': ['a', 'b'],
+                  'empty': ['']}:
+        raise ValueError('ReadForm should parse an urlencoded body.')
+    # Pairs straddling the reads of CHUNK_SIZE bytes
+    value = 'x' * (forumform.CHUNK_SIZE + 100)
+    body = ('a=%s&b=%s' % (value, value)).encode('latin-1')
+    if ReadForm(Env(body)) != {'a': [value], 'b': [value]}:
+        raise ValueError('ReadForm should parse pairs across chunks.')
+    print('1. Urlencoded forms are parsed, whatever their chunks.')
+
+def TestMultipartSplits():
+    body = MultipartBody(Field(b'content', b'hello\r\n--not a delimiter'),
+                         File(b'upload', b'a.txt', b'file\r\ndata'),
+                         Field(b'tag', b''))
+    expected = {'content': ['hello\r\n--not a delimiter'], 'tag': ['']}
+    # Split the body in two at every byte, so every delimiter, header block
+    # and line break is cut in every place once
+    for i in range(len(body) + 1):
+        fields = {}
+        files = Files()
+        parser = Multipart(BOUNDARY, fields, files)
+        parser.Feed(body[:i])
+        parser.Feed(body[i:])
+        parser.Finish()
+        if fields != expected or \
+                files.Got() != [('upload', 'a.txt',
+                                 'application/octet-stream',
+                                 b'file\r\ndata')]:
+            raise ValueError('Multipart should parse a body split at %d.'
+                             % i)
+    # And one byte at a time
+    fields = {}
+    parser = Multipart(BOUNDARY, fields, None)
+    for i in range(len(body)):
+        parser.Feed(body[i:i + 1])
+    parser.Finish()
+    if fields != expected:
+        raise ValueError('Multipart should parse a body fed bytewise.')
+    print('2. Multipart delimiters are found across chunk boundaries.')
+
+def TestFiles():
+    data = bytes(bytearray(range(256))) * 1000
+    body = MultipartBody(Field(b'content', b'with files'),
+                         File(b'upload', b'one.bin', data),
+                         File(b'upload', b'two.bin', b''))
+    files = Files()
+    fields = ReadForm(Env(body, MULTIPART_TYPE), on_file=files)
+    if fields != {'content': ['with files']}:
+        raise ValueError('Files should not be added to the fields.')
+    if files.Got() != [('upload', 'one.bin', 'application/octet-stream',
+                        data),
+                       ('upload', 'two.bin', 'application/octet-stream',
+                        b'')]:
+        raise ValueError('Each file should go to on_file whole.')
+    # Files on_file turns down, or with no on_file at all, are skipped
+    if ReadForm(Env(body, MULTIPART_TYPE), on_file=lambda *args: None) \
+            != fields or ReadForm(Env(body, MULTIPART_TYPE)) != fields:
+        raise ValueError('Skipped files should leave the fields alone.')
+    print('3. Files in a multipart body are handed to on_file.')
+
+def TestTooLarge():
+    if not Raises(TooLarge, ReadForm,
+                  {'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': str(forumform.MAX_BODY + 1),
+                   'wsgi.input': Unreadable()}):
+        raise ValueError('A long urlencoded body should be refused unread.')
+    if not Raises(TooLarge, ReadForm,
+                  {'CONTENT_TYPE': MULTIPART_TYPE,
+                   'CONTENT_LENGTH': str(forumform.MAX_UPLOAD + 1),
+                   'wsgi.input': Unreadable()}):
+        raise ValueError('A long multipart body should be refused unread.')
+    # Files may take a multipart body past the field limit; fields may not
+    body = MultipartBody(Field(b'content', b'small'),
+                         File(b'upload', b'big.bin', b'x' * 5000))
+    if ReadForm(Env(body, MULTIPART_TYPE), limit=1000) != \
+            {'content': ['small']}:
+        raise ValueError('Files should not count towards the field limit.')
+    body = MultipartBody(Field(b'a', b'x' * 600), Field(b'b', b'x' * 600))
+    if not Raises(TooLarge, ReadForm, Env(body, MULTIPART_TYPE),
+                  limit=1000):
+        raise ValueError('Fields together over the limit should be '
+                         'refused.')
+    print('4. Bodies and fields over their limits raise TooLarge.')
+
+def TestBadForm():
+    body = MultipartBody(Field(b'content', b'hello'))
+    bad = [
+        # Shorter than its Content-Length
+        Env(b'content=hello', length=100),
+        Env(body, MULTIPART_TYPE, len(body) + 10),
+        Env(b'content=hello', length='many'),
+        Env(body, 'multipart/form-data'),
+        # Ends inside a part
+        Env(body[:body.rindex(b'--' + BOUNDARY)], MULTIPART_TYPE),
+        # Something other than a line break or -- after a delimiter
+        Env(body.replace(b'--' + BOUNDARY + b'\r\n', b'--' + BOUNDARY + b'!!',
+                         1), MULTIPART_TYPE),
+        Env(MultipartBody((b'Content-Disposition: form-data', b'x')),
+            MULTIPART_TYPE),
+        Env(b'--' + BOUNDARY + b'\r\n' +
+            b'X: y\r\n' * forumform.MAX_PART_HEADERS, MULTIPART_TYPE),
+    ]
+    for i, env in enumerate(bad):
+        if not Raises(BadForm, ReadForm, env):
+            raise ValueError('Malformed body %d should raise BadForm.' % i)
+    print('5. Short and malformed bodies raise BadForm.')
+
+
+if __name__ == '__main__':
+    TestUrlencoded()
+    TestMultipartSplits()
+    TestFiles()
+    TestTooLarge()
+    TestBadForm()
+    print('Success!  All tests pass!')
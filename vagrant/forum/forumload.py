@@ -0,0 +1,103 @@
+#
+# Load test for the web forum - measures requests per second
+#
+# Start the server in the mode to measure, then run this against it:
+#
+#   python forum.py --mode threaded --workers 8
+#   python forumload.py --clients 8 --seconds 10
+#
+# and compare the requests/second each serving mode reaches.
+#
+
+import argparse
+import threading
+import time
+try:
+    from httplib import HTTPException
+    from urllib2 import urlopen
+    from urllib import urlencode
+except ImportError:
+    from http.client import HTTPException
+    from urllib.request import urlopen
+    from urllib.parse import urlencode
+
+## A client records the latency of each successful request it makes
+class Client(object):
+    '''One client thread, sending requests back to back until the deadline.'''
+    def __init__(self, url, paths, post_every, deadline):
+        self.url = url
+        self.paths = paths
+        self.post_every = post_every
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+
+    def Request(self, n):
+        '''Send the client's n'th request.'''
+        if self.post_every and n % self.post_every == self.post_every - 1:
+            data = urlencode({'content': 'Load test post %d' % n})
+            return urlopen(self.url + '/post', data.encode('ascii'))
+        return urlopen(self.url + self.paths[n % len(self.paths)])
+
+    def Run(self):
+        n = 0
+        while time.time() < self.deadline:
+            start = time.time()
+            try:
+                response = self.Request(n)
+                response.read()
+                response.close()
+                self.latencies.append(time.time() - start)
+            except (HTTPException, IOError):
+                self.errors += 1
+            n += 1
+
+def Percentile(ordered, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def Run(url, clients, seconds, paths, post_every):
+    '''Load the server with clients concurrent clients for seconds; return
+    a dictionary of the results.'''
+    deadline = time.time() + seconds
+    workers = [Client(url, paths, post_every, deadline)
+               for i in range(clients)]
+    threads = [threading.Thread(target=w.Run) for w in workers]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(l for w in workers for l in w.latencies)
+    results = {'requests': len(latencies),
+               'errors': sum(w.errors for w in workers),
+               'rps': len(latencies) / elapsed}
+    if latencies:
+        results['p50_ms'] = Percentile(latencies, 0.50) * 1000
+        results['p99_ms'] = Percentile(latencies, 0.99) * 1000
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the DB Forum.')
+    parser.add_argument('--url', default='http://localhost:8000',
+                        help='server to test (default: http://localhost:8000)')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent clients (default: 8)')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='how long to run (default: 10)')
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='path to GET, may be repeated (default: /)')
+    parser.add_argument('--post-every', type=int, default=0,
+                        help='make every Nth request of a client a new post '
+                             '(default: never)')
+    args = parser.parse_args()
+
+    results = Run(args.url.rstrip('/'), args.clients, args.seconds,
+                  args.paths or ['/'], args.post_every)
+    print('%(requests)d requests, %(errors)d errors: %(rps).1f requests/second'
+          % results)
+    if results['requests']:
+        print('latency p50 %(p50_ms).1f ms, p99 %(p99_ms).1f ms' % results)
@@ -0,0 +1,204 @@
+#
+# Request metrics for the web forum, in the Prometheus text format
+#
+# Measure wraps a WSGI app and records, per route: requests by status
+# code, requests in flight, and latency histograms of the whole request,
+# the part of it spent waiting on the database (forumdb.Waited) and the
+# rest, which is rendering. A streamed response ends when the server
+# closes its body, so streamed pages are timed to their last byte.
+#
+# Each thread counts into its own tables, so recording takes no lock; the
+# Metrics handler adds the tables up when scraped. Every server process
+# keeps its own metrics, so a pre-forked server reports per worker.
+#
+
+import bisect
+import threading
+import time
+
+import forumdb
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# Histograms recorded for each request, and their help text
+TIMINGS = (('request', 'Time from request to the end of the response.'),
+           ('db', 'Time spent waiting on the database.'),
+           ('render', 'Time spent on everything but the database.'))
+
+## Per-thread counters
+# Every thread's tables, for Metrics to add up
+TABLES = []
+TABLES_LOCK = threading.Lock()
+LOCAL = threading.local()
+
+def Table():
+    '''The calling thread's counters, created on its first request.
+
+    Returns:
+      A dictionary with 'started' and 'finished' request counts,
+      'requests' mapping (route, status code) to a count, and 'latency'
+      mapping (timing, route) to [bucket counts..., count, sum].
+    '''
+    table = getattr(LOCAL, 'table', None)
+    if table is None:
+        table = {'started': 0, 'finished': 0, 'requests': {}, 'latency': {}}
+        with TABLES_LOCK:
+            TABLES.append(table)
+        LOCAL.table = table
+    return table
+
+def Observe(latency, key, seconds):
+    '''Add one observation to the histogram at latency[key].'''
+    counts = latency.get(key)
+    if counts is None:
+        counts = latency[key] = [0] * (len(BUCKETS) + 2) + [0.0]
+    counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+    counts[-2] += 1
+    counts[-1] += seconds
+
+## The middleware
+def Measure(app, routes):
+    '''Wrap the WSGI app to record metrics for each request.
+
+    Args:
+      app: the WSGI app, such as forum.Dispatcher.
+      routes: the first path components the app serves, such as
+        forum.DISPATCH; requests for any other path count as 'other'.
+    '''
+    def Measured(env, resp):
+        start = time.time()
+        waited = forumdb.Waited()
+        name = env.get('PATH_INFO', '').lstrip('/').split('/', 1)[0]
+        route = '/' + name if name in routes else 'other'
+        status = ['500']
+
+        def StartResponse(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return resp(status_line, headers, exc_info)
+
+        Table()['started'] += 1
+        try:
+            body = app(env, StartResponse)
+        except:
+            Record(route, status[0], time.time() - start,
+                   forumdb.Waited() - waited)
+            raise
+        if isinstance(body, list):
+            # Already complete: count it now, and let servers see a list
+            Record(route, status[0], time.time() - start,
+                   forumdb.Waited() - waited)
+            return body
+        return MeasuredBody(body, route, status, start,
+                            forumdb.Waited() - waited)
+    return Measured
+
+class MeasuredBody(object):
+    '''A response body that records its request's metrics when closed.
+
+    Database time is measured around each step of the body rather than
+    between the request and close(), as servers may step a body on more
+    than one thread.
+    '''
+    def __init__(self, body, route, status, start, waited):
+        self.body = body
+        self.pieces = iter(body)
+        self.route = route
+        self.status = status
+        self.start = start
+        self.waited = waited
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        waited = forumdb.Waited()
+        try:
+            return next(self.pieces)
+        finally:
+            self.waited += forumdb.Waited() - waited
+    next = __next__
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            Record(self.route, self.status[0], time.time() - self.start,
+                   self.waited)
+
+def Record(route, code, seconds, waited):
+    '''Count one finished request.'''
+    table = Table()
+    requests = table['requests']
+    key = (route, code)
+    requests[key] = requests.get(key, 0) + 1
+    latency = table['latency']
+    Observe(latency, ('request', route), seconds)
+    Observe(latency, ('db', route), waited)
+    Observe(latency, ('render', route), max(seconds - waited, 0.0))
+    table['finished'] += 1
+
+## Exposition
+def Totals():
+    '''Add up every thread's tables.
+
+    Returns:
+      (in flight, {(route, code): count}, {(timing, route): histogram})
+    '''
+    with TABLES_LOCK:
+        tables = list(TABLES)
+    started = finished = 0
+    requests = {}
+    latency = {}
+    for table in tables:
+        # Counting the finished first keeps in flight from going negative
+        finished += table['finished']
+        started += table['started']
+        for key, count in list(table['requests'].items()):
+            requests[key] = requests.get(key, 0) + count
+        for key, counts in list(table['latency'].items()):
+            total = latency.setdefault(key, [0] * (len(counts) - 1) + [0.0])
+            for i, count in enumerate(list(counts)):
+                total[i] += count
+    return max(started - finished, 0), requests, latency
+
+def Exposition():
+    '''The current metrics in the Prometheus text format.'''
+    in_flight, requests, latency = Totals()
+    lines = ['# HELP forum_requests_total Requests handled.',
+             '# TYPE forum_requests_total counter']
+    for (route, code), count in sorted(requests.items()):
+        lines.append('forum_requests_total{route="%s",code="%s"} %d'
+                     % (route, code, count))
+    lines += ['# HELP forum_requests_in_flight Requests being handled.',
+              '# TYPE forum_requests_in_flight gauge',
+              'forum_requests_in_flight %d' % in_flight]
+    for timing, help in TIMINGS:
+        name = 'forum_%s_seconds' % timing
+        lines += ['# HELP %s %s' % (name, help),
+                  '# TYPE %s histogram' % name]
+        for key, counts in sorted(latency.items()):
+            if key[0] != timing:
+                continue
+            route = key[1]
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket{route="%s",le="%s"} %d'
+                             % (name, route, bound, cumulative))
+            lines.append('%s_sum{route="%s"} %r' % (name, route, counts[-1]))
+            lines.append('%s_count{route="%s"} %d'
+                         % (name, route, counts[-2]))
+    return '\n'.join(lines) + '\n'
+
+## Request handler for the metrics
+def Metrics(env, resp):
+    '''Metrics serves the request metrics for Prometheus to scrape.'''
+    resp('200 OK', [('Content-type', 'text/plain; version=0.0.4')])
+    return [Exposition()]
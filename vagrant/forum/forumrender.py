@@ -0,0 +1,110 @@
+#
+# HTML templates for the web forum, compiled to string concatenations
+#
+# A template is text with %(name)s fields (and %% for a literal %). Compile
+# turns one into a function taking the fields as arguments and returning
+# the literal pieces and the values added together, so rendering does no
+# format parsing or dictionary lookups. Values are inserted as they are:
+# escape anything a user typed, once, before it gets here.
+#
+
+import re
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+# HTML template for the forum page
+HTML_WRAP = '''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>DB Forum</title>
+    <style>
+      h1, form { text-align: center; }
+      textarea { width: 400px; height: 100px; }
+      div.post { border: 1px solid #999;
+                 padding: 10px 10px;
+		 margin: 10px 20%%; }
+      hr.postbound { width: 50%%; }
+      em.date { color: #999 }
+    </style>
+  </head>
+  <body>
+    <h1>DB Forum</h1>
+    <form method=post action="/post">
+      <div><textarea id="content" name="content"></textarea></div>
+      <div><button id="go" type="submit">Post message</button></div>
+    </form>
+    <form method=get action="/search">
+      <div><input name="q"> <button type="submit">Search</button></div>
+    </form>
+    <!-- post content will go here -->
+%(posts)s
+  </body>
+</html>
+'''
+
+# HTML template for an individual comment
+POST = '''\
+    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+'''
+
+# HTML template for the link to the next page of older posts
+OLDER = '''\
+    <p class=nav><a href="/?before=%(cursor)s">Older posts</a></p>
+'''
+
+# HTML templates for the top of the search results and the link to the
+# next page of them
+SEARCHED = '''\
+    <p class=nav>Posts matching <b>%(q)s</b>:</p>
+'''
+MORE_RESULTS = '''\
+    <p class=nav><a href="/search?q=%(q)s&amp;page=%(page)s">More results</a></p>
+'''
+
+FIELD = re.compile(r'%\((\w+)\)s')
+
+def Compile(template, name):
+    '''Compile a template into a function called name.
+
+    Compile(POST, 'Post') returns the equivalent of
+
+      def Post(time, content):
+          return '    <div class=post><em class=date>' + time + ...
+
+    with the fields as arguments in the order they first appear.
+    '''
+    pieces = FIELD.split(template)
+    fields = []
+    terms = []
+    for i, piece in enumerate(pieces):
+        if i % 2:
+            if piece not in fields:
+                fields.append(piece)
+            terms.append(piece)
+        elif piece:
+            terms.append(repr(piece.replace('%%', '%')))
+    source = 'def %s(%s):\n    return %s\n' % (
+        name, ', '.join(fields), ' + '.join(terms) or "''")
+    namespace = {}
+    exec(compile(source, '<template %s>' % name, 'exec'), namespace)
+    return namespace[name]
+
+Wrap = Compile(HTML_WRAP, 'Wrap')
+Post = Compile(POST, 'Post')
+Older = Compile(OLDER, 'Older')
+Searched = Compile(SEARCHED, 'Searched')
+MoreResults = Compile(MORE_RESULTS, 'MoreResults')
+
+# The forum page around its posts, for sending the page in pieces
+HTML_HEAD, HTML_FOOT = Wrap('\0').split('\0')
+
+def Escape(text):
+    '''Escape text for use in HTML, attribute values included.'''
+    return escape(text, True)
+
+def Fragment(content, time):
+    '''The HTML of one post, from its raw content and its time.'''
+    return Post(time=str(time), content=Escape(content))
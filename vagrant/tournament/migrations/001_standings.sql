@@ -0,0 +1,57 @@
+-- Replace the player_omws / player_standings views with the incrementally
+-- maintained standings table, populated from the existing matches.
+DROP VIEW IF EXISTS player_standings;
+DROP VIEW IF EXISTS player_omws;
+
+CREATE TABLE IF NOT EXISTS standings ( player INTEGER PRIMARY KEY
+                                           REFERENCES players(id)
+                                           ON DELETE CASCADE,
+                                       tournament INTEGER
+                                           REFERENCES tournaments(id),
+                                       wins INTEGER NOT NULL DEFAULT 0,
+                                       ties INTEGER NOT NULL DEFAULT 0,
+                                       matches INTEGER NOT NULL DEFAULT 0,
+                                       points INTEGER NOT NULL DEFAULT 0,
+                                       omw INTEGER NOT NULL DEFAULT 0,
+                                       byes INTEGER NOT NULL DEFAULT 0 );
+
+CREATE INDEX IF NOT EXISTS standings_tournament_idx ON standings (tournament);
+
+CREATE VIEW player_standings AS
+    SELECT s.tournament, s.player, p.name, s.wins, s.ties, s.matches,
+        s.points, s.omw, s.byes
+    FROM standings AS s JOIN players AS p
+    ON p.id = s.player
+    ORDER BY s.wins DESC, s.ties DESC, s.omw DESC, s.matches DESC;
+
+-- Same computation as TournamentSession.rebuildStandings()
+INSERT INTO standings (player, tournament)
+    SELECT p.id, p.tournament FROM players AS p
+    WHERE NOT EXISTS (SELECT 1 FROM standings AS s WHERE s.player = p.id);
+
+WITH results AS (
+    SELECT winner AS player, loser AS opponent,
+        CASE WHEN draw THEN 0 ELSE 1 END AS win,
+        CASE WHEN draw THEN 1 ELSE 0 END AS tie
+    FROM matches
+    UNION ALL
+    SELECT loser, winner, 0, CASE WHEN draw THEN 1 ELSE 0 END
+    FROM matches),
+totals AS (
+    SELECT player, SUM(win) AS wins, SUM(tie) AS ties, COUNT(*) AS matches
+    FROM results GROUP BY player),
+omws AS (
+    SELECT r.player, SUM(t.wins) AS omw
+    FROM results AS r JOIN totals AS t ON t.player = r.opponent
+    GROUP BY r.player)
+UPDATE standings AS s
+SET wins = COALESCE(t.wins, 0),
+    ties = COALESCE(t.ties, 0),
+    matches = COALESCE(t.matches, 0),
+    points = COALESCE(3 * t.wins + t.ties, 0),
+    omw = COALESCE(o.omw, 0),
+    byes = COALESCE(p.byes, 0)
+FROM players AS p
+LEFT JOIN totals AS t ON t.player = p.id
+LEFT JOIN omws AS o ON o.player = p.id
+WHERE s.player = p.id;
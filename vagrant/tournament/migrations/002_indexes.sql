@@ -0,0 +1,9 @@
+-- Tournament-scoped indexes. Every standings, pairing and delete query
+-- filters matches by tournament and winner or loser, and players by
+-- tournament. The trailing columns make the matches indexes covering, so
+-- those lookups are answered from the index alone.
+CREATE INDEX IF NOT EXISTS matches_tournament_winner_idx
+    ON matches (tournament, winner, loser, draw);
+CREATE INDEX IF NOT EXISTS matches_tournament_loser_idx
+    ON matches (tournament, loser, winner, draw);
+CREATE INDEX IF NOT EXISTS players_tournament_idx ON players (tournament);
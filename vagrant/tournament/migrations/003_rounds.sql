@@ -0,0 +1,17 @@
+-- Rounds of each tournament and the pairings stored for them by startRound.
+-- At most one round per tournament is open (not completed) at a time.
+CREATE TABLE rounds ( id SERIAL PRIMARY KEY,
+                      tournament INTEGER NOT NULL
+                          REFERENCES tournaments(id) ON DELETE CASCADE,
+                      number INTEGER NOT NULL,
+                      bye INTEGER REFERENCES players(id) ON DELETE SET NULL,
+                      completed BOOLEAN NOT NULL DEFAULT FALSE,
+                      UNIQUE (tournament, number) );
+
+CREATE TABLE pairings ( round INTEGER REFERENCES rounds(id) ON DELETE CASCADE,
+                        board INTEGER,
+                        player1 INTEGER
+                            REFERENCES players(id) ON DELETE CASCADE,
+                        player2 INTEGER
+                            REFERENCES players(id) ON DELETE CASCADE,
+                        PRIMARY KEY (round, board) );
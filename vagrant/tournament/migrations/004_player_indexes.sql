@@ -0,0 +1,7 @@
+-- Indexes for the foreign keys that point at players. Deleting players
+-- checks matches and pairings for rows referencing each one; without these
+-- every deleted player costs a scan of both tables.
+CREATE INDEX IF NOT EXISTS matches_winner_idx ON matches (winner);
+CREATE INDEX IF NOT EXISTS matches_loser_idx ON matches (loser);
+CREATE INDEX IF NOT EXISTS pairings_player1_idx ON pairings (player1);
+CREATE INDEX IF NOT EXISTS pairings_player2_idx ON pairings (player2);
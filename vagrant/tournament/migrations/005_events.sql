@@ -0,0 +1,49 @@
+-- Append-only log of what happened in each tournament, oldest first:
+--   register: player joined
+--   result: player beat opponent (or drew with them), recorded as match
+--   bye: player sat out a round
+--   correction: the result recorded as match was withdrawn
+-- Players and matches are not foreign keys, so the log outlives them.
+CREATE TABLE events ( id BIGSERIAL PRIMARY KEY,
+                      tournament INTEGER NOT NULL
+                          REFERENCES tournaments(id) ON DELETE CASCADE,
+                      kind TEXT NOT NULL
+                          CHECK (kind IN ('register', 'result', 'bye',
+                                          'correction')),
+                      player INTEGER NOT NULL,
+                      opponent INTEGER,
+                      draw BOOLEAN,
+                      match INTEGER,
+                      recorded TIMESTAMP DEFAULT CURRENT_TIMESTAMP );
+
+CREATE INDEX events_tournament_idx ON events (tournament, id);
+
+-- Standings of a tournament as of one event, taken when a round is
+-- completed. Replaying a tournament starts from its latest snapshot and
+-- applies only the events after it.
+--
+-- Columns: as standings, plus the opponents of each match played (once per
+-- match) so later results and corrections can update omw.
+CREATE TABLE snapshots ( tournament INTEGER NOT NULL
+                             REFERENCES tournaments(id) ON DELETE CASCADE,
+                         event BIGINT NOT NULL,
+                         player INTEGER NOT NULL,
+                         wins INTEGER NOT NULL,
+                         ties INTEGER NOT NULL,
+                         matches INTEGER NOT NULL,
+                         omw INTEGER NOT NULL,
+                         byes INTEGER NOT NULL,
+                         opponents INTEGER[] NOT NULL,
+                         PRIMARY KEY (tournament, event, player) );
+
+-- Start the log from the data already recorded
+INSERT INTO events (tournament, kind, player)
+    SELECT tournament, 'register', id FROM players
+    WHERE tournament IS NOT NULL ORDER BY id;
+INSERT INTO events (tournament, kind, player)
+    SELECT p.tournament, 'bye', p.id
+    FROM players AS p, generate_series(1, p.byes)
+    WHERE p.tournament IS NOT NULL ORDER BY p.id;
+INSERT INTO events (tournament, kind, player, opponent, draw, match)
+    SELECT tournament, 'result', winner, loser, draw, id FROM matches
+    WHERE tournament IS NOT NULL ORDER BY id;
@@ -0,0 +1,62 @@
+-- Optional layout: list-partition matches by tournament (PostgreSQL 11+).
+--
+-- Each tournament gets its own matches partition, created by a trigger when
+-- the tournament is registered, so queries for one tournament only touch
+-- its partition and deleting a finished event's matches never scans the
+-- archive. Rows for tournaments without a partition land in matches_default.
+--
+-- Apply with: python tournament_migrate.py --partition-matches
+ALTER TABLE matches RENAME TO matches_unpartitioned;
+ALTER INDEX matches_pkey RENAME TO matches_unpartitioned_pkey;
+ALTER INDEX IF EXISTS matches_tournament_winner_idx
+    RENAME TO matches_unpartitioned_winner_idx;
+ALTER INDEX IF EXISTS matches_tournament_loser_idx
+    RENAME TO matches_unpartitioned_loser_idx;
+DROP INDEX IF EXISTS matches_winner_idx;
+DROP INDEX IF EXISTS matches_loser_idx;
+
+CREATE TABLE matches (  id INTEGER NOT NULL
+                            DEFAULT nextval('matches_id_seq'),
+                        tournament INTEGER NOT NULL
+                            REFERENCES tournaments(id),
+                        winner INTEGER REFERENCES players(id),
+                        loser INTEGER REFERENCES players(id),
+                        draw BOOLEAN,
+                        PRIMARY KEY (tournament, id) )
+    PARTITION BY LIST (tournament);
+
+ALTER SEQUENCE matches_id_seq OWNED BY matches.id;
+
+CREATE INDEX matches_tournament_winner_idx
+    ON matches (tournament, winner, loser, draw);
+CREATE INDEX matches_tournament_loser_idx
+    ON matches (tournament, loser, winner, draw);
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+
+CREATE TABLE matches_default PARTITION OF matches DEFAULT;
+
+CREATE FUNCTION create_matches_partition(t_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS matches_t%s
+                    PARTITION OF matches FOR VALUES IN (%s)', t_id, t_id);
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION tournaments_create_matches_partition() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM create_matches_partition(NEW.id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournaments_matches_partition
+    AFTER INSERT ON tournaments
+    FOR EACH ROW EXECUTE PROCEDURE tournaments_create_matches_partition();
+
+SELECT create_matches_partition(id) FROM tournaments;
+
+INSERT INTO matches (id, tournament, winner, loser, draw)
+    SELECT id, tournament, winner, loser, draw FROM matches_unpartitioned;
+
+DROP TABLE matches_unpartitioned;
@@ -3,8 +3,31 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
 import psycopg2
 
+import tournament_tracing
+
+from tournament_pairing import chooseBye, pairRound, pairRounds
+from tournament_pool import ConnectionPool
+from tournament_statements import (ASSIGN_BYE, LOCK_TOURNAMENT,
+                                   LOCKED_SNAPSHOT, OPEN_ROUND,
+                                   REGISTER_PLAYER, REPORT_MATCH,
+                                   REPORT_MATCH_OMW, REPORT_MATCH_STANDINGS,
+                                   STANDINGS, TOURNAMENT_MATCHES)
+from tournament_tiebreaks import Tiebreaks
+from tournament_tracing import TracingCursor, traced
+
+# Rows sent per multi-row INSERT by the bulk functions
+BULK_CHUNK_SIZE = 1000
+
+# Whether sessions PREPARE the hot-path Statements of tournament_statements on
+# each connection (see tournament_pool.PreparingConnection) rather than send
+# their SQL
+PREPARE_STATEMENTS = True
+
 
 def connect(database_name="tournament"):
     try:
@@ -15,24 +38,768 @@ def connect(database_name="tournament"):
         print("Error: Could not connect to database")
 
 
+class TournamentSession(object):
+    """Tournament database API over a pool of reusable connections.
+
+    Every method runs in a single transaction on a connection borrowed from
+    the pool, so no method pays for connection setup. The module-level
+    functions below delegate to a shared default session; create a session
+    directly to use a different pool.
+
+    Args:
+        pool: a ConnectionPool (a default sized pool is created if omitted)
+    """
+
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        # (round id, pairings) of each tournament's open round, by
+        # tournament id. An entry is only served while that round is still
+        # the open one, so rounds started or completed by other sessions
+        # and processes are seen; this session also drops entries whenever
+        # it starts or completes a round or deletes the data behind it.
+        self._current_pairings = {}
+
+    @contextmanager
+    def cursor(self):
+        """Yields a cursor in a transaction that commits when the block exits
+        normally and rolls back if it raises."""
+        tracing = tournament_tracing.enabled()
+        if tracing:
+            start = timer()
+        with self.pool.connection() as db:
+            if tracing:
+                tournament_tracing.acquired(timer() - start)
+                c = db.cursor(cursor_factory=TracingCursor)
+            else:
+                c = db.cursor()
+            try:
+                yield c
+                db.commit()
+            except:
+                db.rollback()
+                raise
+            finally:
+                c.close()
+
+    def _nextIds(self, c, table, count):
+        """Reserves count serial ids of table, returned in ascending order."""
+        query = """SELECT nextval(pg_get_serial_sequence(%s, 'id'))
+                   FROM generate_series(1, %s)"""
+        c.execute(query, (table, count))
+        return sorted(row[0] for row in c.fetchall())
+
+    def _run(self, c, statement, params):
+        """Runs a Statement with a dict of params, preparing it first if the
+        connection has not yet."""
+        prepared = getattr(c.connection, 'prepared', None)
+        if not PREPARE_STATEMENTS or prepared is None:
+            c.execute(statement.query, params)
+            return
+        if statement.name not in prepared:
+            # Not one of the caller's statements, so not traced as one
+            setup = c.connection.cursor()
+            try:
+                setup.execute(statement.prepare)
+            finally:
+                setup.close()
+            prepared.add(statement.name)
+        c.execute(statement.execute, statement.args(params))
+
+    def _insertMany(self, c, statement, template, rows):
+        """Runs statement once per BULK_CHUNK_SIZE rows with a multi-row
+        VALUES list built by formatting template with each row."""
+        statement = statement.encode()
+        for i in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[i:i + BULK_CHUNK_SIZE]
+            c.execute(statement +
+                      b",".join(c.mogrify(template, row) for row in chunk))
+
+    def _rebuildStandings(self, c, t_id=None):
+        """Recomputes standings rows from the matches table, for one
+        tournament or for every tournament when t_id is None."""
+        query_missing = """INSERT INTO standings (player, tournament)
+                           SELECT p.id, p.tournament FROM players AS p
+                           WHERE (%(t)s IS NULL OR p.tournament = %(t)s)
+                           AND NOT EXISTS (SELECT 1 FROM standings AS s
+                                           WHERE s.player = p.id)"""
+        c.execute(query_missing, {'t': t_id})
+
+        # Right after a bulk load the planner still thinks matches is tiny
+        # and may nest loops over the CTEs below, which is quadratic.
+        c.execute("SET LOCAL enable_nestloop = off")
+
+        # Each match seen from both sides: (player, opponent, win, tie)
+        query = """WITH results AS (
+                       SELECT winner AS player, loser AS opponent,
+                           CASE WHEN draw THEN 0 ELSE 1 END AS win,
+                           CASE WHEN draw THEN 1 ELSE 0 END AS tie
+                       FROM matches
+                       WHERE %(t)s IS NULL OR tournament = %(t)s
+                       UNION ALL
+                       SELECT loser, winner, 0,
+                           CASE WHEN draw THEN 1 ELSE 0 END
+                       FROM matches
+                       WHERE %(t)s IS NULL OR tournament = %(t)s),
+                   totals AS (
+                       SELECT player, SUM(win) AS wins, SUM(tie) AS ties,
+                           COUNT(*) AS matches
+                       FROM results GROUP BY player),
+                   omws AS (
+                       SELECT r.player, SUM(t.wins) AS omw
+                       FROM results AS r JOIN totals AS t
+                       ON t.player = r.opponent
+                       GROUP BY r.player)
+                   UPDATE standings AS s
+                   SET wins = COALESCE(t.wins, 0),
+                       ties = COALESCE(t.ties, 0),
+                       matches = COALESCE(t.matches, 0),
+                       points = COALESCE(3 * t.wins + t.ties, 0),
+                       omw = COALESCE(o.omw, 0),
+                       byes = p.byes
+                   FROM players AS p
+                   LEFT JOIN totals AS t ON t.player = p.id
+                   LEFT JOIN omws AS o ON o.player = p.id
+                   WHERE s.player = p.id
+                   AND (%(t)s IS NULL OR s.tournament = %(t)s)"""
+        c.execute(query, {'t': t_id})
+
+    def close(self):
+        """Closes the idle connections of the session's pool."""
+        self.pool.closeall()
+
+    @traced
+    def deleteMatches(self):
+        """Remove all the match records from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM rounds")
+            c.execute("DELETE FROM matches")
+            c.execute("""DELETE FROM events
+                         WHERE kind IN ('result', 'correction')""")
+            c.execute("DELETE FROM snapshots")
+            c.execute("""UPDATE standings SET wins = 0, ties = 0, matches = 0,
+                                              points = 0, omw = 0""")
+        self._current_pairings.clear()
+
+    @traced
+    def deletePlayers(self):
+        """Remove all the player records from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM players")
+            c.execute("DELETE FROM events")
+            c.execute("DELETE FROM snapshots")
+        self._current_pairings.clear()
+
+    @traced
+    def deleteTournamentPlayers(self, t_id):
+        """Remove all the player records of a tournament from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM players WHERE tournament = %s", (t_id,))
+            c.execute("DELETE FROM events WHERE tournament = %s", (t_id,))
+            c.execute("DELETE FROM snapshots WHERE tournament = %s", (t_id,))
+        self._current_pairings.pop(t_id, None)
+
+    @traced
+    def deleteTournaments(self):
+        """Remove all the tournament records from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM tournaments")
+        self._current_pairings.clear()
+
+    @traced
+    def deleteTournament(self, t_id):
+        """Remove specific tournament records from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM tournaments WHERE id = %s", (t_id,))
+        self._current_pairings.pop(t_id, None)
+
+    @traced
+    def deleteTournamentMatches(self, t_id):
+        """Remove all the match records of a tournament from the database."""
+        with self.cursor() as c:
+            c.execute("DELETE FROM rounds WHERE tournament = %s", (t_id,))
+            c.execute("DELETE FROM matches WHERE tournament = %s", (t_id,))
+            c.execute("""DELETE FROM events WHERE tournament = %s
+                         AND kind IN ('result', 'correction')""", (t_id,))
+            c.execute("DELETE FROM snapshots WHERE tournament = %s", (t_id,))
+            c.execute("""UPDATE standings SET wins = 0, ties = 0, matches = 0,
+                                              points = 0, omw = 0
+                         WHERE tournament = %s""", (t_id,))
+        self._current_pairings.pop(t_id, None)
+
+    @traced
+    def countPlayers(self):
+        """Returns the number of players currently registered."""
+        with self.cursor() as c:
+            c.execute("SELECT COUNT(*) AS num FROM players")
+            return c.fetchone()[0]
+
+    @traced
+    def countTournamentPlayers(self, t_id):
+        """Returns the number of players registered in a tournament."""
+        with self.cursor() as c:
+            query = """SELECT COUNT(*) AS num FROM player_standings
+                       WHERE tournament = %s"""
+            c.execute(query, (t_id,))
+            return c.fetchone()[0]
+
+    @traced
+    def registerPlayer(self, name, t_id):
+        """Adds a player to a tournament."""
+        params = {'name': name, 't': t_id}
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, params)
+            self._run(c, REGISTER_PLAYER, params)
+
+    @traced
+    def registerPlayers(self, t_id, names):
+        """Adds many players to a tournament in one transaction; returns
+        their ids in the order of names."""
+        names = list(names)
+        if not names:
+            return []
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, {'t': t_id})
+            ids = self._nextIds(c, "players", len(names))
+            self._insertMany(
+                c, "INSERT INTO players (id, name, tournament, byes) VALUES ",
+                "(%s, %s, %s, 0)",
+                [(id, name, t_id) for id, name in zip(ids, names)])
+            query = """WITH s AS (INSERT INTO standings (player, tournament)
+                                 SELECT id, %(t)s FROM unnest(%(ids)s) AS id)
+                       INSERT INTO events (tournament, kind, player)
+                       SELECT %(t)s, 'register', id FROM unnest(%(ids)s) AS id"""
+            c.execute(query, {'t': t_id, 'ids': ids})
+        return ids
+
+    @traced
+    def getTournamentPlayers(self, t_id):
+        """Returns all players of a tournament."""
+        with self.cursor() as c:
+            query = "SELECT * FROM players WHERE tournament = %s"
+            c.execute(query, (t_id,))
+            return c.fetchall()
+
+    @traced
+    def registerTournament(self, name):
+        """Adds a tournament and returns its id."""
+        with self.cursor() as c:
+            query = "INSERT INTO tournaments (name) VALUES(%s) RETURNING id"
+            c.execute(query, (name,))
+            return c.fetchone()[0]
+
+    @traced
+    def playerStandings(self, t_id, tiebreaks=None):
+        """Returns the standings of a tournament, first place first, ordered
+        by a chain of tournament_tiebreaks measures if one is given."""
+        with self.cursor() as c:
+            self._run(c, STANDINGS, {'t': t_id})
+            standings = c.fetchall()
+            if not tiebreaks:
+                return standings
+            self._run(c, TOURNAMENT_MATCHES, {'t': t_id})
+            matches = c.fetchall()
+
+        computed = Tiebreaks([row[0] for row in standings], matches,
+                             dict((row[0], row[6]) for row in standings))
+        key = computed.sortKey(tiebreaks)
+        return sorted(standings, key=lambda row: key(row[0]))
+
+    @traced
+    def reportMatch(self, t_id, winner, loser, draw=False):
+        """Records the outcome of a single match between two players;
+        returns the match id."""
+        draw = bool(draw)
+        params = {'t': t_id, 'w': winner, 'l': loser, 'd': draw}
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, params)
+            self._run(c, REPORT_MATCH, params)
+            match_id = c.fetchone()[0]
+
+            # Both players add the match, and each other's wins to their omw
+            self._run(c, REPORT_MATCH_STANDINGS, params)
+
+            if not draw:
+                # The winner has one more win, so the omw of everyone they
+                # have played (this loser included) goes up once per match
+                self._run(c, REPORT_MATCH_OMW, params)
+        return match_id
+
+    @traced
+    def reportMatches(self, t_id, results):
+        """Records many match outcomes in one transaction; returns the match
+        ids in the order of results."""
+        rows = []
+        for result in results:
+            draw = bool(result[2]) if len(result) > 2 else False
+            rows.append((result[0], result[1], draw))
+        if not rows:
+            return []
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, {'t': t_id})
+            ids = self._nextIds(c, "matches", len(rows))
+            self._insertMany(
+                c, """INSERT INTO matches (id, tournament, winner, loser, draw)
+                      VALUES """,
+                "(%s, %s, %s, %s, %s)",
+                [(id, t_id) + row for id, row in zip(ids, rows)])
+            query = """INSERT INTO events
+                           (tournament, kind, player, opponent, draw, match)
+                       SELECT tournament, 'result', winner, loser, draw, id
+                       FROM matches WHERE tournament = %s AND id = ANY(%s)
+                       ORDER BY id"""
+            c.execute(query, (t_id, ids))
+            # One pass over the tournament beats a per-row incremental update
+            self._rebuildStandings(c, t_id)
+        return ids
+
+    @traced
+    def rebuildStandings(self, t_id=None):
+        """Recomputes standings from the recorded matches."""
+        with self.cursor() as c:
+            self._rebuildStandings(c, t_id)
+
+    @traced
+    def undoMatch(self, t_id, match_id):
+        """Withdraws a recorded result, logging a correction event; returns
+        the (winner, loser, draw) withdrawn."""
+        params = {'t': t_id, 'm': match_id}
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, params)
+            query = """WITH m AS (DELETE FROM matches
+                                 WHERE tournament = %(t)s AND id = %(m)s
+                                 RETURNING id, winner, loser, draw)
+                       INSERT INTO events
+                           (tournament, kind, player, opponent, draw, match)
+                       SELECT %(t)s, 'correction', winner, loser, draw, id
+                       FROM m
+                       RETURNING player, opponent, draw"""
+            c.execute(query, params)
+            row = c.fetchone()
+            if row is None:
+                raise ValueError("No match {} in tournament {}.".format(
+                    match_id, t_id))
+            params.update(w=row[0], l=row[1], d=row[2])
+
+            # reportMatch in reverse: the winner loses the win, so the omw
+            # of everyone they still have played goes down once per match
+            if not row[2]:
+                query = """UPDATE standings AS s SET omw = s.omw - o.n
+                           FROM (SELECT CASE WHEN winner = %(w)s
+                                        THEN loser ELSE winner END AS player,
+                                     COUNT(*) AS n
+                                 FROM matches
+                                 WHERE tournament = %(t)s
+                                 AND (winner = %(w)s OR loser = %(w)s)
+                                 GROUP BY 1) AS o
+                           WHERE s.player = o.player"""
+                c.execute(query, params)
+
+            # Then both players drop the match and each other's wins
+            query = """UPDATE standings AS s
+                       SET matches = s.matches - 1,
+                           wins = s.wins - CASE WHEN %(d)s THEN 0
+                               WHEN s.player = %(w)s THEN 1 ELSE 0 END,
+                           ties = s.ties - CASE WHEN %(d)s THEN 1 ELSE 0 END,
+                           points = s.points - CASE WHEN %(d)s THEN 1
+                               WHEN s.player = %(w)s THEN 3 ELSE 0 END,
+                           omw = s.omw - o.wins
+                       FROM standings AS o
+                       WHERE (s.player = %(w)s AND o.player = %(l)s)
+                       OR (s.player = %(l)s AND o.player = %(w)s)"""
+            c.execute(query, params)
+        return row
+
+    def _snapshotStandings(self, c, t_id):
+        """Saves a tournament's standings as of its latest event, replacing
+        any older snapshot of it.
+
+        The tournament is locked first. Every event is logged under the same
+        lock, so none with a lower id can still be uncommitted and land
+        behind the snapshot, where replayStandings would skip it.
+        """
+        self._run(c, LOCK_TOURNAMENT, {'t': t_id})
+        query = """WITH last AS (SELECT max(id) AS event FROM events
+                                 WHERE tournament = %(t)s),
+                   old AS (DELETE FROM snapshots
+                           WHERE tournament = %(t)s
+                           AND event < (SELECT event FROM last))
+                   INSERT INTO snapshots (tournament, event, player, wins,
+                                          ties, matches, omw, byes, opponents)
+                   SELECT s.tournament, last.event, s.player, s.wins, s.ties,
+                       s.matches, s.omw, s.byes,
+                       ARRAY(SELECT CASE WHEN m.winner = s.player
+                                    THEN m.loser ELSE m.winner END
+                             FROM matches AS m
+                             WHERE m.tournament = s.tournament
+                             AND (m.winner = s.player
+                                  OR m.loser = s.player))
+                   FROM standings AS s, last
+                   WHERE s.tournament = %(t)s AND last.event IS NOT NULL
+                   ON CONFLICT DO NOTHING"""
+        c.execute(query, {'t': t_id})
+
+    @traced
+    def snapshotStandings(self, t_id):
+        """Saves a snapshot of a tournament's standings for replayStandings."""
+        with self.cursor() as c:
+            self._snapshotStandings(c, t_id)
+
+    @traced
+    def replayStandings(self, t_id):
+        """Rebuilds a tournament's standings from its latest snapshot and the
+        events logged after it; returns the number of events replayed."""
+        with self.cursor() as c:
+            self._run(c, LOCK_TOURNAMENT, {'t': t_id})
+            query = """SELECT event, player, wins, ties, matches, omw, byes,
+                           opponents
+                       FROM snapshots
+                       WHERE tournament = %(t)s
+                       AND event = (SELECT max(event) FROM snapshots
+                                    WHERE tournament = %(t)s)"""
+            c.execute(query, {'t': t_id})
+            event = 0
+            players = {}
+            for row in c.fetchall():
+                event = row[0]
+                players[row[1]] = {'wins': row[2], 'ties': row[3],
+                                   'matches': row[4], 'omw': row[5],
+                                   'byes': row[6], 'opponents': row[7]}
+
+            query = """SELECT kind, player, opponent, draw FROM events
+                       WHERE tournament = %s AND id > %s ORDER BY id"""
+            c.execute(query, (t_id, event))
+            events = c.fetchall()
+            _applyEvents(players, events)
+            if not players:
+                return len(events)
+
+            ids = sorted(players)
+            columns = [[players[id][column] for id in ids]
+                       for column in ('wins', 'ties', 'matches', 'omw',
+                                      'byes')]
+            query = """UPDATE standings AS s
+                       SET wins = r.wins, ties = r.ties, matches = r.matches,
+                           points = 3 * r.wins + r.ties, omw = r.omw,
+                           byes = r.byes
+                       FROM unnest(%s::int[], %s::int[], %s::int[],
+                                   %s::int[], %s::int[], %s::int[])
+                           AS r(player, wins, ties, matches, omw, byes)
+                       WHERE s.player = r.player AND s.tournament = %s"""
+            c.execute(query, [ids] + columns + [t_id])
+        return len(events)
+
+    def _lockedSnapshot(self, c, t_id):
+        """Locks a tournament for pairing and returns its standings, best
+        first, as (id, name, byes, opponent ids) rows.
+
+        The lock is on the tournament's own row, so pairing one tournament
+        never waits on another.
+        """
+        self._run(c, LOCKED_SNAPSHOT, {'t': t_id})
+        return c.fetchall()
+
+    def _lockedSnapshots(self, c, t_ids):
+        """Locks several tournaments for pairing and returns all of their
+        standings with one query.
+
+        The tournaments' rows are locked in id order, so two callers pairing
+        overlapping sets of tournaments cannot deadlock.
+
+        Returns:
+            A dict of tournament id to its (id, name, byes, opponent ids)
+            rows, best first; tournaments that do not exist are left out
+        """
+        query = """WITH locked AS (
+                       SELECT id FROM tournaments WHERE id = ANY(%s)
+                       ORDER BY id FOR UPDATE)
+                   SELECT t.id, s.player, p.name, s.byes,
+                       ARRAY(SELECT CASE WHEN m.winner = s.player
+                                    THEN m.loser ELSE m.winner END
+                             FROM matches AS m
+                             WHERE m.tournament = s.tournament
+                             AND (m.winner = s.player
+                                  OR m.loser = s.player)) AS opponents
+                   FROM locked AS t
+                   LEFT JOIN standings AS s ON s.tournament = t.id
+                   LEFT JOIN players AS p ON p.id = s.player
+                   ORDER BY t.id, s.wins DESC, s.ties DESC, s.omw DESC,
+                       s.player"""
+        c.execute(query, (list(t_ids),))
+        snapshots = {}
+        for row in c.fetchall():
+            rows = snapshots.setdefault(row[0], [])
+            if row[1] is not None:
+                rows.append(row[1:])
+        return snapshots
+
+    def _assignBye(self, c, t_id, id):
+        self._run(c, ASSIGN_BYE, {'p': id, 't': t_id})
+
+    def _assignByes(self, c, ids):
+        query = """WITH p AS (UPDATE players SET byes = byes + 1
+                              WHERE id = ANY(%s)
+                              RETURNING id, tournament),
+                   s AS (UPDATE standings SET byes = standings.byes + 1
+                         FROM p WHERE standings.player = p.id)
+                   INSERT INTO events (tournament, kind, player)
+                   SELECT tournament, 'bye', id FROM p ORDER BY id"""
+        c.execute(query, (ids,))
+
+    @traced
+    def checkForEvenPlayers(self, players, t_id):
+        """Assigns a bye if players is odd; returns the (id, name) list of the
+        players left to pair."""
+        if len(players) % 2 == 0:
+            return players
+
+        with self.cursor() as c:
+            byes = dict((row[0], row[2])
+                        for row in self._lockedSnapshot(c, t_id))
+            id = chooseBye([row[0] for row in players], byes)
+            self._assignBye(c, t_id, id)
+
+        return [(row[0], row[1]) for row in players if row[0] != id]
+
+    def _pairRound(self, c, t_id):
+        """Pairs the next round of a locked tournament, assigning any bye.
+        Returns the (id1, name1, id2, name2) pairings and the bye's id."""
+        rows = self._lockedSnapshot(c, t_id)
+        ranked = [row[0] for row in rows]
+        names = dict((row[0], row[1]) for row in rows)
+        byes = dict((row[0], row[2]) for row in rows)
+        opponents = dict((row[0], set(row[3])) for row in rows)
+
+        pairs, bye = pairRound(ranked, opponents, byes)
+        if bye is not None:
+            self._assignBye(c, t_id, bye)
+
+        return [(id1, names[id1], id2, names[id2]) for id1, id2 in pairs], bye
+
+    @traced
+    def swissPairings(self, t_id):
+        """Returns (id1, name1, id2, name2) pairings for the next round."""
+        # One transaction, two statements: snapshot under lock, then the bye
+        with self.cursor() as c:
+            return self._pairRound(c, t_id)[0]
+
+    @traced
+    def startRound(self, t_id):
+        """Pairs and stores the next round; returns its pairings."""
+        with self.cursor() as c:
+            query = """SELECT r.number, r.completed
+                       FROM tournaments AS t LEFT JOIN rounds AS r
+                       ON r.tournament = t.id
+                       WHERE t.id = %s
+                       ORDER BY r.number DESC LIMIT 1
+                       FOR UPDATE OF t"""
+            c.execute(query, (t_id,))
+            row = c.fetchone()
+            if row is None:
+                raise ValueError("No tournament with id {}.".format(t_id))
+            number, completed = row
+            if number is not None and not completed:
+                raise ValueError("Round {} of tournament {} has not been "
+                                 "completed.".format(number, t_id))
+
+            pairings, bye = self._pairRound(c, t_id)
+
+            query = """INSERT INTO rounds (tournament, number, bye)
+                       VALUES (%s, %s, %s) RETURNING id"""
+            c.execute(query, (t_id, (number or 0) + 1, bye))
+            round_id = c.fetchone()[0]
+            self._insertMany(
+                c, "INSERT INTO pairings (round, board, player1, player2) "
+                   "VALUES ", "(%s, %s, %s, %s)",
+                [(round_id, board, p[0], p[2])
+                 for board, p in enumerate(pairings, 1)])
+
+        self._current_pairings[t_id] = (round_id, pairings)
+        return pairings
+
+    @traced
+    def pairAll(self, t_ids, processes=None):
+        """Pairs and stores the next round of several tournaments in one
+        transaction; returns {t_id: pairings}."""
+        t_ids = sorted(set(t_ids))
+        if not t_ids:
+            return {}
+        with self.cursor() as c:
+            snapshots = self._lockedSnapshots(c, t_ids)
+            missing = [t_id for t_id in t_ids if t_id not in snapshots]
+            if missing:
+                raise ValueError("No tournament with id {}.".format(
+                    ", ".join(str(t_id) for t_id in missing)))
+
+            query = """SELECT DISTINCT ON (tournament)
+                           tournament, number, completed
+                       FROM rounds WHERE tournament = ANY(%s)
+                       ORDER BY tournament, number DESC"""
+            c.execute(query, (t_ids,))
+            numbers = {}
+            for t_id, number, completed in c.fetchall():
+                if not completed:
+                    raise ValueError("Round {} of tournament {} has not "
+                                     "been completed.".format(number, t_id))
+                numbers[t_id] = number
+
+            results = pairRounds(
+                [([row[0] for row in snapshots[t_id]],
+                  dict((row[0], set(row[3])) for row in snapshots[t_id]),
+                  dict((row[0], row[2]) for row in snapshots[t_id]))
+                 for t_id in t_ids], processes)
+
+            byes = [bye for pairs, bye in results if bye is not None]
+            if byes:
+                self._assignByes(c, byes)
+
+            rounds = [c.mogrify("(%s, %s, %s)",
+                                (t_id, numbers.get(t_id, 0) + 1, bye))
+                      for t_id, (pairs, bye) in zip(t_ids, results)]
+            c.execute(b"INSERT INTO rounds (tournament, number, bye) "
+                      b"VALUES " + b",".join(rounds) +
+                      b" RETURNING tournament, id")
+            round_ids = dict(c.fetchall())
+
+            all_pairings = {}
+            rows = []
+            for t_id, (pairs, bye) in zip(t_ids, results):
+                names = dict((row[0], row[1]) for row in snapshots[t_id])
+                pairings = [(id1, names[id1], id2, names[id2])
+                            for id1, id2 in pairs]
+                all_pairings[t_id] = pairings
+                rows.extend((round_ids[t_id], board, id1, id2)
+                            for board, (id1, id2) in enumerate(pairs, 1))
+            self._insertMany(
+                c, "INSERT INTO pairings (round, board, player1, player2) "
+                   "VALUES ", "(%s, %s, %s, %s)", rows)
+
+        self._current_pairings.update(
+            (t_id, (round_ids[t_id], pairings))
+            for t_id, pairings in all_pairings.items())
+        return all_pairings
+
+    @traced
+    def getCurrentPairings(self, t_id):
+        """Returns the pairings of the open round, cached by round: while the
+        open round stays the same, a call only looks up its id."""
+        with self.cursor() as c:
+            self._run(c, OPEN_ROUND, {'t': t_id})
+            row = c.fetchone()
+            if row is None:
+                self._current_pairings.pop(t_id, None)
+                return []
+            round_id = row[0]
+            cached = self._current_pairings.get(t_id)
+            if cached is not None and cached[0] == round_id:
+                return cached[1]
+            query = """SELECT pr.player1, p1.name, pr.player2, p2.name
+                       FROM pairings AS pr
+                       JOIN players AS p1 ON p1.id = pr.player1
+                       JOIN players AS p2 ON p2.id = pr.player2
+                       WHERE pr.round = %s
+                       ORDER BY pr.board"""
+            c.execute(query, (round_id,))
+            pairings = c.fetchall()
+        if pairings:
+            self._current_pairings[t_id] = (round_id, pairings)
+        return pairings
+
+    @traced
+    def completeRound(self, t_id):
+        """Marks the open round completed; returns its number, or None."""
+        with self.cursor() as c:
+            query = """UPDATE rounds SET completed = TRUE
+                       WHERE tournament = %s AND NOT completed
+                       RETURNING number"""
+            c.execute(query, (t_id,))
+            row = c.fetchone()
+            if row:
+                self._snapshotStandings(c, t_id)
+        self._current_pairings.pop(t_id, None)
+        return row[0] if row else None
+
+
+def _applyEvents(players, events):
+    """Applies logged (kind, player, opponent, draw) events, oldest first,
+    to standings held as a dict of player id to a dict of wins, ties,
+    matches, omw, byes and opponents (one entry per match played), making
+    the same updates as reportMatch and undoMatch."""
+    for kind, id, opponent, draw in events:
+        if kind == 'register':
+            players[id] = {'wins': 0, 'ties': 0, 'matches': 0, 'omw': 0,
+                           'byes': 0, 'opponents': []}
+            continue
+        if kind == 'bye':
+            players[id]['byes'] += 1
+            continue
+
+        winner, loser = players[id], players[opponent]
+        if kind == 'result':
+            winner['omw'] += loser['wins']
+            loser['omw'] += winner['wins']
+            winner['opponents'].append(opponent)
+            loser['opponents'].append(id)
+            step = 1
+        else:
+            winner['opponents'].remove(opponent)
+            loser['opponents'].remove(id)
+            step = -1
+        if not draw:
+            for other in winner['opponents']:
+                players[other]['omw'] += step
+        if kind == 'correction':
+            winner['omw'] -= loser['wins']
+            loser['omw'] -= winner['wins']
+
+        winner['matches'] += step
+        loser['matches'] += step
+        if draw:
+            winner['ties'] += step
+            loser['ties'] += step
+        else:
+            winner['wins'] += step
+
+
+_session = None
+
+
+def configure(database_name="tournament", minconn=1, maxconn=10, **kwargs):
+    """Replaces the default session used by the module-level functions.
+
+    Args:
+        database_name: name of the database to connect to
+        minconn: number of connections opened up front
+        maxconn: upper bound on pooled connections
+        kwargs: further ConnectionPool options (timeout, check_after)
+
+    Returns:
+        The new default TournamentSession
+    """
+    global _session
+    if _session is not None:
+        _session.close()
+    _session = TournamentSession(ConnectionPool(database_name, minconn,
+                                                maxconn, **kwargs))
+    return _session
+
+
+def getSession():
+    """Returns the default session, creating it on first use."""
+    if _session is None:
+        configure()
+    return _session
+
+
 def deleteMatches():
     """Remove all the match records from the database."""
-    db, c = connect()
-
-    query = "DELETE FROM matches"
-    c.execute(query)
-    db.commit()
-    db.close()
+    getSession().deleteMatches()
 
 
 def deletePlayers():
     """Remove all the player records from the database."""
-    db, c = connect()
-
-    query = "DELETE FROM players"
-    c.execute(query)
-    db.commit()
-    db.close()
+    getSession().deletePlayers()
 
 
 def deleteTournamentPlayers(t_id):
@@ -42,22 +809,12 @@ def deleteTournamentPlayers(t_id):
         t_id: Tournament ID (unique)
 
     """
-    db, c = connect()
-
-    query = "DELETE FROM players WHERE tournament = %s"
-    c.execute(query, (t_id,))
-    db.commit()
-    db.close()
+    getSession().deleteTournamentPlayers(t_id)
 
 
 def deleteTournaments():
     """Remove all the tournament records from the database."""
-    db, c = connect()
-
-    query = "DELETE FROM tournaments"
-    c.execute(query)
-    db.commit()
-    db.close()
+    getSession().deleteTournaments()
 
 
 def deleteTournament(t_id):
@@ -67,12 +824,7 @@ def deleteTournament(t_id):
         t_id: Tournament ID (unique)
 
     """
-    db, c = connect()
-
-    query = "DELETE FROM tournaments WHERE tournament = %s"
-    c.execute(query, (t_id,))
-    db.commit()
-    db.close()
+    getSession().deleteTournament(t_id)
 
 
 def deleteTournamentMatches(t_id):
@@ -82,24 +834,12 @@ def deleteTournamentMatches(t_id):
         t_id: Tournament ID (unique)
 
     """
-    db, c = connect()
-
-    query = "DELETE FROM matches WHERE tournament = %s"
-    c.execute(query, (t_id,))
-    db.commit()
-    db.close()
+    getSession().deleteTournamentMatches(t_id)
 
 
 def countPlayers():
     """Returns the number of players currently registered."""
-    db, c = connect()
-
-    query = "SELECT COUNT(*) AS num FROM players"
-    c.execute(query)
-    count = c.fetchone()[0]
-    db.close()
-
-    return count
+    return getSession().countPlayers()
 
 
 def countTournamentPlayers(t_id):
@@ -110,15 +850,7 @@ def countTournamentPlayers(t_id):
             t_id: tournament id (unique)
 
     """
-    db, c = connect()
-
-    query = """SELECT COUNT(*) AS num FROM player_standings
-               WHERE tournament = %s"""
-    c.execute(query, (t_id,))
-    count = c.fetchone()[0]
-    db.close()
-
-    return count
+    return getSession().countTournamentPlayers(t_id)
 
 
 def registerPlayer(name, t_id):
@@ -131,13 +863,23 @@ def registerPlayer(name, t_id):
         name: the player's full name (need not be unique).
         t_id: tournament id (unique).
     """
-    db, c = connect()
+    getSession().registerPlayer(name, t_id)
+
+
+def registerPlayers(t_id, names):
+    """Adds many players to a specific tournament in a single transaction.
 
-    query_player = "INSERT INTO players (name, tournament, byes) VALUES(%s, %s, %s)"
-    c.execute(query_player, (name, t_id, 0))
+    Rows are sent as multi-row INSERTs, so importing thousands of players
+    costs a handful of round trips instead of one commit per player.
 
-    db.commit()
-    db.close()
+    Args:
+        t_id: tournament id (unique).
+        names: an iterable of the players' full names.
+
+    Returns:
+        A list of the new players' ids, in the same order as names
+    """
+    return getSession().registerPlayers(t_id, names)
 
 
 def getTournamentPlayers(t_id):
@@ -146,14 +888,7 @@ def getTournamentPlayers(t_id):
     Args:
         t_id: tournament id (unique)
     """
-
-    db, c = connect()
-    query = "SELECT * FROM players WHERE tournament = %s"
-    c.execute(query, (t_id,))
-    players = c.fetchall()
-    db.close()
-
-    return players
+    return getSession().getTournamentPlayers(t_id)
 
 
 def registerTournament(name):
@@ -168,19 +903,10 @@ def registerTournament(name):
     Returns:
         id: tournament id (unique) for use in other functions
     """
-    db, c = connect()
-
-    query = "INSERT INTO tournaments (name) VALUES(%s) RETURNING id"
-    c.execute(query, (name,))
-    id = c.fetchone()[0]
+    return getSession().registerTournament(name)
 
-    db.commit()
-    db.close()
 
-    return id
-
-
-def playerStandings(t_id):
+def playerStandings(t_id, tiebreaks=None):
     """Returns a list of the players and their total wins, sorted by wins, in
     a specific tournament.
 
@@ -189,6 +915,10 @@ def playerStandings(t_id):
 
     Args:
         t_id: tournament id (unique).
+        tiebreaks: optional sequence of tournament_tiebreaks.MEASURES, e.g.
+            ('score', 'omw_pct', 'buchholz', 'sonneborn_berger'). Players are
+            then sorted by each measure in turn, computed from the
+            tournament's matches, instead of by wins, ties and omw.
 
     Returns:
       A list of tuples, each of which contains
@@ -198,18 +928,10 @@ def playerStandings(t_id):
         wins: total wins
         ties: total ties
         matches: the number of matches the player has played
-        omw: total points of opponents a player has faced
+        omw: total wins of the opponents a player has faced
         byes: the number of skips rounds player has in case of uneven players
     """
-    db, c = connect()
-
-    query = """SELECT player, name, wins, ties, matches, omw, byes
-               FROM player_standings WHERE tournament = %s"""
-    c.execute(query, (t_id,))
-    players = c.fetchall()
-    db.close()
-
-    return players
+    return getSession().playerStandings(t_id, tiebreaks)
 
 
 def reportMatch(t_id, winner, loser, draw=False):
@@ -221,22 +943,95 @@ def reportMatch(t_id, winner, loser, draw=False):
         winner: the id number of the player who won
         loser: the id number of the player who lost
         draw: boolean of if match was a tie. Changes points allotted in match
+
+    Returns:
+        The new match's id, for undoMatch
     """
+    return getSession().reportMatch(t_id, winner, loser, draw)
 
-    db, c = connect()
 
-    query_match = """INSERT INTO matches (tournament, winner, loser, draw)
-                     VALUES (%s, %s, %s, %s)"""
-    c.execute(query_match, (t_id, winner, loser, draw))
+def reportMatches(t_id, results):
+    """Records the outcomes of many matches in a single transaction.
 
-    db.commit()
-    db.close()
+    Args:
+        t_id: the tournament id
+        results: an iterable of (winner, loser) or (winner, loser, draw)
+            tuples, as they would be passed to reportMatch
+
+    Returns:
+        A list of the new match ids, in the same order as results
+    """
+    return getSession().reportMatches(t_id, results)
+
+
+def rebuildStandings(t_id=None):
+    """Recomputes the standings table from the matches table.
+
+    reportMatch keeps standings up to date incrementally; this is the repair
+    path if they ever drift (e.g. after editing matches by hand).
+
+    Args:
+        t_id: the tournament id, or None to rebuild every tournament
+    """
+    getSession().rebuildStandings(t_id)
+
+
+def undoMatch(t_id, match_id):
+    """Withdraws a misreported result.
+
+    The match is deleted and a correction event appended to the log; the
+    standings are updated by reversing reportMatch, in three statements
+    whatever the size of the tournament, so nothing has to be wiped and
+    entered again.
+
+    Args:
+        t_id: the tournament id
+        match_id: the id of the match, as returned by reportMatch
+
+    Returns:
+        The (winner, loser, draw) result withdrawn
+
+    Raises:
+        ValueError: the tournament has no such match
+    """
+    return getSession().undoMatch(t_id, match_id)
+
+
+def snapshotStandings(t_id):
+    """Saves a snapshot of a tournament's standings as of its latest event.
+
+    completeRound takes one at the end of every round; only the latest
+    snapshot of each tournament is kept.
+
+    Args:
+        t_id: the tournament id
+    """
+    getSession().snapshotStandings(t_id)
+
+
+def replayStandings(t_id):
+    """Rebuilds a tournament's standings from its event log.
+
+    Replay starts from the latest snapshot and applies only the
+    registrations, results, byes and corrections logged after it, so it
+    reads a round's worth of events rather than every match.
+
+    Args:
+        t_id: the tournament id
+
+    Returns:
+        The number of events replayed on top of the snapshot
+    """
+    return getSession().replayStandings(t_id)
 
 
 def checkForEvenPlayers(players, t_id):
     """Returns an even number of players, assigning a bye to one of the players,
     if there was an odd number of players to begin with
 
+    The bye goes to the highest placed player in players who has had the
+    fewest byes in this tournament (see tournament_pairing.chooseBye).
+
     Args:
         players: a list of tuples containing (id, name) of the player
         t_id: tournament id
@@ -245,44 +1040,22 @@ def checkForEvenPlayers(players, t_id):
         A even list of tuples containing (id, name) of the player, excluding
         the player assigned the bye if the initial list length was an odd
     """
-
-    if len(players) % 2 != 0:
-        db, c = connect()
-
-        # Get player standings and select 1st place player without a bye (id)
-        query = """SELECT player FROM player_standings WHERE byes = 0 LIMIT 1"""
-        c.execute(query)
-        id = c.fetchone()[0]
-
-        # Update player with (id) to have a bye in players table
-        query_bye = "UPDATE players SET byes=1 WHERE id = %s"
-        c.execute(query_bye, (id,))
-
-        # Get List of players excluding player with (id)
-        query_players = """SELECT ps.player, p.name
-                           FROM player_standings AS ps, players AS p
-                           WHERE ps.player != %s AND ps.player = p.id
-                           AND ps.tournament = %s"""
-        c.execute(query_players, (id, t_id))
-        players_modified = c.fetchall()
-
-        db.commit()
-        db.close()
-
-        # Return modified players list of tuples (id, name)
-        return players_modified
-    else:
-        return players
+    return getSession().checkForEvenPlayers(players, t_id)
 
 
 def swissPairings(t_id):
     """Returns a list of pairs of players for the next round of a match in a
     specific tournament.
 
+    If there is an odd number of players registered, one of them is assigned a
+    bye in the same transaction (see checkForEvenPlayers) and left out.
+
     Assuming that there are an even number of players registered, each player
     appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    player with an equal or nearly-equal win record, that is, the nearest
+    player in the standings they have not played yet (see
+    tournament_pairing.pairPlayers). Rematches only happen when no pairing
+    can avoid them.
 
     Args:
         t_id: the tournament id
@@ -294,25 +1067,86 @@ def swissPairings(t_id):
             id2: the second player's unique id
             name2: the second player's name
     """
+    return getSession().swissPairings(t_id)
 
-    db, c = connect()
 
-    query = """SELECT ps.player, p.name
-               FROM player_standings AS ps, players AS p
-               WHERE ps.player = p.id AND ps.tournament = %s
-               ORDER BY ps.wins DESC, ps.ties DESC"""
-    c.execute(query, (t_id,))
-    players = c.fetchall()
+def startRound(t_id):
+    """Pairs the next round of a tournament and stores it as the current round.
 
-    players = checkForEvenPlayers(players, t_id)
+    The pairings are computed once (as by swissPairings, including any bye)
+    and saved in the rounds and pairings tables, so getCurrentPairings can
+    serve them without recomputing.
+
+    Args:
+        t_id: the tournament id
+
+    Returns:
+        The round's pairings, as (id1, name1, id2, name2) tuples
+
+    Raises:
+        ValueError: the tournament does not exist, or its latest round has
+            not been completed
+    """
+    return getSession().startRound(t_id)
+
+
+def pairAll(t_ids, processes=None):
+    """Pairs and stores the next round of several tournaments at once.
+
+    Works like startRound on each tournament, but all of them are read with
+    a single query, paired in parallel across a pool of processes (see
+    tournament_pairing.pairRounds) and written back in one transaction, so
+    a weekend of side events takes about as long as its largest event.
+
+    Args:
+        t_ids: the tournament ids
+        processes: number of pairing processes, None for one per CPU and 1
+            to pair in this process
+
+    Returns:
+        A dict of tournament id to its round's (id1, name1, id2, name2)
+        pairings
+
+    Raises:
+        ValueError: a tournament does not exist, or its latest round has
+            not been completed; no round is started in that case
+    """
+    return getSession().pairAll(t_ids, processes)
+
+
+def getCurrentPairings(t_id):
+    """Returns the pairings of a tournament's current (open) round.
+
+    The session caches the pairings of each open round. While that round
+    stays open a call costs one lookup of the open round's id. Rounds
+    started or completed by other sessions or processes change that id, so
+    they are seen on the next call.
+
+    Args:
+        t_id: the tournament id
+
+    Returns:
+        A list of (id1, name1, id2, name2) tuples, empty if no round is open
+    """
+    return getSession().getCurrentPairings(t_id)
+
+
+def completeRound(t_id):
+    """Marks a tournament's current round as completed.
+
+    Args:
+        t_id: the tournament id
+
+    Returns:
+        The number of the round completed, or None if no round was open
+    """
+    return getSession().completeRound(t_id)
 
-    pairings = []
-    for i in range(0, len(players), 2):
-        # Append a tuple (player1 id, player1 name, player2 id, player2 name)
-        pairings.append(
-            (players[i][0], players[i][1], players[i+1][0], players[i+1][1],)
-        )
 
-    db.close()
+if __name__ == '__main__':
+    # python tournament.py rebuild [t_id] -- repair the standings table
+    import sys
 
-    return pairings
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "rebuild":
+        sys.exit("Usage: tournament.py rebuild [t_id]")
+    rebuildStandings(int(sys.argv[2]) if len(sys.argv) == 3 else None)
@@ -9,6 +9,15 @@ DROP DATABASE IF EXISTS tournament;
 CREATE DATABASE tournament;
 \c tournament;
 
+-- Migrations already part of this schema (see tournament_migrate.py)
+CREATE TABLE schema_migrations ( version TEXT PRIMARY KEY,
+                                 applied TIMESTAMP
+                                     DEFAULT CURRENT_TIMESTAMP );
+
+INSERT INTO schema_migrations (version)
+    VALUES ('001_standings'), ('002_indexes'), ('003_rounds'),
+           ('004_player_indexes'), ('005_events');
+
 CREATE TABLE tournaments (  id SERIAL PRIMARY KEY,
                             name TEXT );
 
@@ -23,42 +32,109 @@ CREATE TABLE matches (  id SERIAL PRIMARY KEY,
                         loser INTEGER REFERENCES players(id),
                         draw BOOLEAN );
 
--- View for OMW
+-- Tournament-scoped indexes. Every standings, pairing and delete query
+-- filters matches by tournament and winner or loser, and players by
+-- tournament. The trailing columns make the matches indexes covering.
+--
+-- Tips: for a list-partitioned matches table (one partition per tournament)
+-- run "python tournament_migrate.py --partition-matches" after this file.
+CREATE INDEX matches_tournament_winner_idx
+    ON matches (tournament, winner, loser, draw);
+CREATE INDEX matches_tournament_loser_idx
+    ON matches (tournament, loser, winner, draw);
+CREATE INDEX players_tournament_idx ON players (tournament);
+
+-- Standings, one row per player, kept up to date by tournament.py in the
+-- same transaction that records a match so reads never aggregate matches.
 --
--- Columns: player id from matches, sum of wins
+-- Columns: player id, tournament, wins, ties, matches, points (3 per win,
+-- 1 per tie), omw (total wins of every opponent faced), byes
 --
--- Tips: Left Join matches and player wins table. Match matches table losers to
--- player winner table (subquery) winners and add their total wins.
-CREATE VIEW player_omws AS
-    SELECT m.winner AS player, COALESCE(SUM(pw.wins), 0) AS omw
-    FROM matches as m LEFT JOIN
-        -- Player Wins Table (Subquery)
-        (SELECT winner AS player, COUNT(*) as wins
-            FROM matches
-            GROUP BY player) as pw
-    ON m.loser = pw.player
-    GROUP BY m.winner;
+-- Tips: rebuildStandings() in tournament.py recomputes these rows from the
+-- matches table if they ever drift.
+CREATE TABLE standings ( player INTEGER PRIMARY KEY
+                             REFERENCES players(id) ON DELETE CASCADE,
+                         tournament INTEGER REFERENCES tournaments(id),
+                         wins INTEGER NOT NULL DEFAULT 0,
+                         ties INTEGER NOT NULL DEFAULT 0,
+                         matches INTEGER NOT NULL DEFAULT 0,
+                         points INTEGER NOT NULL DEFAULT 0,
+                         omw INTEGER NOT NULL DEFAULT 0,
+                         byes INTEGER NOT NULL DEFAULT 0 );
+
+CREATE INDEX standings_tournament_idx ON standings (tournament);
 
 -- View for Player Standings
 --
--- Columns: tournament, player(id), name, wins, ties, omw, matches
--- Order By: tournament, wins, ties, omw
---
--- Tips: Left Join players table to matches (Group by player id)
+-- Columns: tournament, player(id), name, wins, ties, matches, points, omw,
+-- byes
+-- Order By: wins, ties, omw, matches
 CREATE VIEW player_standings AS
-    SELECT p.tournament, p.id AS player, p.name,
-        (SELECT COUNT(*) 
-            FROM matches
-            WHERE winner = p.id AND draw = 'f') AS wins,
-        (SELECT COUNT(*) 
-            FROM matches
-            WHERE (winner = p.id OR loser = p.id) AND draw = 't') AS ties,
-        (SELECT COUNT(*) 
-            FROM matches
-            WHERE winner = p.id OR loser = p.id) AS matches,
-        (SELECT omw FROM player_omws WHERE player = p.id) as omw,
-        (SELECT byes FROM players WHERE id = p.id) as byes        
-    FROM players AS p LEFT JOIN matches AS m
-    ON (p.id = m.winner OR p.id = m.loser)
-    GROUP BY p.id
-    ORDER BY wins DESC, ties DESC, omw DESC, matches DESC;
+    SELECT s.tournament, s.player, p.name, s.wins, s.ties, s.matches,
+        s.points, s.omw, s.byes
+    FROM standings AS s JOIN players AS p
+    ON p.id = s.player
+    ORDER BY s.wins DESC, s.ties DESC, s.omw DESC, s.matches DESC;
+
+-- Rounds of each tournament and the pairings stored for them by startRound.
+-- At most one round per tournament is open (not completed) at a time.
+CREATE TABLE rounds ( id SERIAL PRIMARY KEY,
+                      tournament INTEGER NOT NULL
+                          REFERENCES tournaments(id) ON DELETE CASCADE,
+                      number INTEGER NOT NULL,
+                      bye INTEGER REFERENCES players(id) ON DELETE SET NULL,
+                      completed BOOLEAN NOT NULL DEFAULT FALSE,
+                      UNIQUE (tournament, number) );
+
+CREATE TABLE pairings ( round INTEGER REFERENCES rounds(id) ON DELETE CASCADE,
+                        board INTEGER,
+                        player1 INTEGER
+                            REFERENCES players(id) ON DELETE CASCADE,
+                        player2 INTEGER
+                            REFERENCES players(id) ON DELETE CASCADE,
+                        PRIMARY KEY (round, board) );
+
+-- Indexes for the foreign keys that point at players, so deleting players
+-- does not scan matches and pairings once per player.
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+CREATE INDEX pairings_player1_idx ON pairings (player1);
+CREATE INDEX pairings_player2_idx ON pairings (player2);
+
+-- Append-only log of what happened in each tournament, oldest first:
+--   register: player joined
+--   result: player beat opponent (or drew with them), recorded as match
+--   bye: player sat out a round
+--   correction: the result recorded as match was withdrawn
+-- Players and matches are not foreign keys, so the log outlives them.
+CREATE TABLE events ( id BIGSERIAL PRIMARY KEY,
+                      tournament INTEGER NOT NULL
+                          REFERENCES tournaments(id) ON DELETE CASCADE,
+                      kind TEXT NOT NULL
+                          CHECK (kind IN ('register', 'result', 'bye',
+                                          'correction')),
+                      player INTEGER NOT NULL,
+                      opponent INTEGER,
+                      draw BOOLEAN,
+                      match INTEGER,
+                      recorded TIMESTAMP DEFAULT CURRENT_TIMESTAMP );
+
+CREATE INDEX events_tournament_idx ON events (tournament, id);
+
+-- Standings of a tournament as of one event, taken when a round is
+-- completed. Replaying a tournament starts from its latest snapshot and
+-- applies only the events after it.
+--
+-- Columns: as standings, plus the opponents of each match played (once per
+-- match) so later results and corrections can update omw.
+CREATE TABLE snapshots ( tournament INTEGER NOT NULL
+                             REFERENCES tournaments(id) ON DELETE CASCADE,
+                         event BIGINT NOT NULL,
+                         player INTEGER NOT NULL,
+                         wins INTEGER NOT NULL,
+                         ties INTEGER NOT NULL,
+                         matches INTEGER NOT NULL,
+                         omw INTEGER NOT NULL,
+                         byes INTEGER NOT NULL,
+                         opponents INTEGER[] NOT NULL,
+                         PRIMARY KEY (tournament, event, player) );
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio counterpart of tournament.py (Python 3.5+)
+#
+# register_player, report_match, player_standings and swiss_pairings are
+# coroutines over an asyncpg connection pool, with the same statements and
+# results as their blocking namesakes in tournament.py, so a front end on an
+# event loop can serve many scorekeepers without a thread for each. The SQL
+# is tournament_statements' in its $N form; asyncpg prepares and caches each
+# statement per connection itself. Queries that do not depend on each other
+# are sent on separate pooled connections at once rather than one after
+# another.
+#
+#   await configure(database_name="tournament")
+#   pairings = await swiss_pairings(t_id)
+#
+
+import asyncio
+
+import asyncpg
+
+from tournament_pairing import pairRound
+from tournament_statements import (ASSIGN_BYE, LOCK_TOURNAMENT,
+                                   LOCKED_SNAPSHOT, REGISTER_PLAYER,
+                                   REPORT_MATCH, REPORT_MATCH_OMW,
+                                   REPORT_MATCH_STANDINGS, STANDINGS,
+                                   TOURNAMENT_MATCHES)
+from tournament_tiebreaks import Tiebreaks
+
+
+_pool = None
+
+
+async def configure(database_name="tournament", min_size=1, max_size=10,
+                    **kwargs):
+    """Replaces the pool used by the coroutines in this module.
+
+    Args:
+        database_name: name of the database to connect to
+        min_size, max_size: bounds on the number of pooled connections
+        kwargs: passed on to asyncpg.create_pool
+    """
+    global _pool
+    old, _pool = _pool, await asyncpg.create_pool(
+        database=database_name, min_size=min_size, max_size=max_size,
+        **kwargs)
+    if old is not None:
+        await old.close()
+    return _pool
+
+
+async def get_pool():
+    """Returns the pool, creating a default one on first use."""
+    if _pool is None:
+        await configure()
+    return _pool
+
+
+async def close():
+    """Closes the pool's connections."""
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+async def register_player(name, t_id):
+    """Adds a player to a tournament.
+
+    Args:
+        name: the player's full name (need not be unique)
+        t_id: tournament id
+    """
+    params = {'name': name, 't': t_id}
+    pool = await get_pool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            await db.execute(LOCK_TOURNAMENT.numbered, t_id)
+            await db.execute(REGISTER_PLAYER.numbered,
+                             *REGISTER_PLAYER.args(params))
+
+
+async def report_match(t_id, winner, loser, draw=False):
+    """Records the outcome of a single match between two players.
+
+    Args:
+        t_id: the tournament id
+        winner: the id number of the player who won
+        loser: the id number of the player who lost
+        draw: whether the match was a tie
+
+    Returns:
+        The new match's id
+    """
+    draw = bool(draw)
+    params = {'t': t_id, 'w': winner, 'l': loser, 'd': draw}
+    pool = await get_pool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            await db.execute(LOCK_TOURNAMENT.numbered, t_id)
+            match_id = await db.fetchval(REPORT_MATCH.numbered,
+                                         *REPORT_MATCH.args(params))
+
+            # Both players add the match, and each other's wins to their omw
+            await db.execute(REPORT_MATCH_STANDINGS.numbered,
+                             *REPORT_MATCH_STANDINGS.args(params))
+
+            if not draw:
+                # The winner has one more win, so the omw of everyone they
+                # have played (this loser included) goes up once per match
+                await db.execute(REPORT_MATCH_OMW.numbered,
+                                 *REPORT_MATCH_OMW.args(params))
+    return match_id
+
+
+async def player_standings(t_id, tiebreaks=None):
+    """Returns the standings of a tournament as playerStandings does:
+    (id, name, wins, ties, matches, omw, byes) tuples, first place first,
+    ordered by a chain of tournament_tiebreaks measures if one is given.
+
+    With tiebreaks, the standings and the matches they are computed from
+    are fetched at the same time on two connections.
+    """
+    pool = await get_pool()
+    if not tiebreaks:
+        return [tuple(row) for row in
+                await pool.fetch(STANDINGS.numbered, t_id)]
+
+    standings, matches = await asyncio.gather(
+        pool.fetch(STANDINGS.numbered, t_id),
+        pool.fetch(TOURNAMENT_MATCHES.numbered, t_id))
+    standings = [tuple(row) for row in standings]
+    computed = Tiebreaks([row[0] for row in standings],
+                         [tuple(row) for row in matches],
+                         dict((row[0], row[6]) for row in standings))
+    key = computed.sortKey(tiebreaks)
+    return sorted(standings, key=lambda row: key(row[0]))
+
+
+async def swiss_pairings(t_id):
+    """Returns (id1, name1, id2, name2) pairings for the next round,
+    assigning a bye first if the tournament has an odd number of players.
+
+    The tournament stays locked from its snapshot to the bye, as in
+    swissPairings; the pairing search itself runs in the loop's default
+    executor so a large tournament does not stall other coroutines.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            rows = await db.fetch(LOCKED_SNAPSHOT.numbered, t_id)
+            ranked = [row[0] for row in rows]
+            names = dict((row[0], row[1]) for row in rows)
+            byes = dict((row[0], row[2]) for row in rows)
+            opponents = dict((row[0], set(row[3])) for row in rows)
+
+            loop = asyncio.get_event_loop()
+            pairs, bye = await loop.run_in_executor(
+                None, pairRound, ranked, opponents, byes)
+            if bye is not None:
+                params = {'p': bye, 't': t_id}
+                await db.execute(ASSIGN_BYE.numbered, *ASSIGN_BYE.args(params))
+
+    return [(id1, names[id1], id2, names[id2]) for id1, id2 in pairs]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+#
+# Runs the test cases of tournament_test.py against tournament_async.py
+#
+# The tests call registerPlayer, reportMatch, playerStandings and
+# swissPairings as blocking functions; here each of those names is pointed
+# at the matching coroutine, run to completion on one event loop, and the
+# tests run as they do in tournament_test.py.
+
+import asyncio
+
+import tournament_async
+import tournament_test
+
+# Tests of tournament.py internals the async functions do not go through:
+# tracing instruments its psycopg2 cursors
+SKIP = ('testTracing',)
+
+
+def blocking(loop, coroutine_function):
+    """Returns a function that runs coroutine_function on loop and waits
+    for its result."""
+    def call(*args):
+        return loop.run_until_complete(coroutine_function(*args))
+    return call
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(tournament_async.configure())
+
+    tournament_test.registerPlayer = blocking(
+        loop, tournament_async.register_player)
+    tournament_test.reportMatch = blocking(loop, tournament_async.report_match)
+    tournament_test.playerStandings = blocking(
+        loop, tournament_async.player_standings)
+    tournament_test.swissPairings = blocking(
+        loop, tournament_async.swiss_pairings)
+
+    tests = [value for name, value in vars(tournament_test).items()
+             if name.startswith('test') and name not in SKIP]
+    for test in sorted(tests, key=lambda test: test.__code__.co_firstlineno):
+        test()
+
+    loop.run_until_complete(tournament_async.close())
+    loop.close()
+    print("Success!  All tests pass with tournament_async!")
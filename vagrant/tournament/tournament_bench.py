@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# tournament_bench.py -- time the tournament API on synthetic tournaments
+#
+# Builds a tournament for each size, plays it for a number of Swiss rounds
+# with random results, then deletes it, timing every API call along the way.
+# Latency percentiles and throughput per function are written as JSON so
+# runs can be compared. Needs a local database created from tournament.sql;
+# only the benchmark's own tournaments are touched.
+#
+# With --planning SIZE it also plays a SIZE-player tournament twice over,
+# with the hot-path statements sent as plain SQL and then as prepared
+# statements, and reports the call latencies and the server's planning time
+# of each way.
+#
+# Usage: python tournament_bench.py [--sizes 100,1000] [--rounds 5]
+#                                   [--samples 200] [--planning 10000]
+#                                   [--output FILE]
+#
+
+import argparse
+import json
+import random
+import sys
+import time
+from timeit import default_timer as timer
+
+import psycopg2
+
+import tournament
+from tournament_pool import ConnectionPool
+
+
+class Timings(object):
+    """Collects call latencies per operation name."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, name, function, *args):
+        """Calls function(*args), records how long it took, and returns its
+        result."""
+        start = timer()
+        result = function(*args)
+        self.samples.setdefault(name, []).append(timer() - start)
+        return result
+
+    def summary(self):
+        """Returns {name: stats} with latencies in milliseconds."""
+        return dict((name, summarize(samples))
+                    for name, samples in self.samples.items())
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {'calls': len(ordered),
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+            'mean_ms': total / len(ordered) * 1000,
+            'ops_per_sec': len(ordered) / total if total else None}
+
+
+def benchTournament(session, size, rounds, samples, rng):
+    """Plays one synthetic tournament of size players; returns its Timings.
+
+    The first samples players and matches of each round go through the
+    single-row calls (registerPlayer, reportMatch) to measure their latency;
+    the rest are loaded with the bulk calls so large sizes stay practical.
+    """
+    timings = Timings()
+    t_id = session.registerTournament("Benchmark {}".format(size))
+
+    names = ["Player {}".format(i) for i in range(size)]
+    single = min(samples, size)
+    for name in names[:single]:
+        timings.time('registerPlayer', session.registerPlayer, name, t_id)
+    if size > single:
+        timings.time('registerPlayers', session.registerPlayers, t_id,
+                     names[single:])
+
+    for round in range(rounds):
+        pairings = timings.time('swissPairings', session.swissPairings, t_id)
+        results = []
+        for id1, name1, id2, name2 in pairings:
+            draw = rng.random() < 0.05
+            if rng.random() < 0.5:
+                id1, id2 = id2, id1
+            results.append((id1, id2, draw))
+        for result in results[:samples]:
+            timings.time('reportMatch', session.reportMatch, t_id, *result)
+        if len(results) > samples:
+            timings.time('reportMatches', session.reportMatches, t_id,
+                         results[samples:])
+        for i in range(3):
+            timings.time('playerStandings', session.playerStandings, t_id)
+
+    timings.time('countTournamentPlayers', session.countTournamentPlayers,
+                 t_id)
+    timings.time('deleteTournamentMatches', session.deleteTournamentMatches,
+                 t_id)
+    timings.time('deleteTournamentPlayers', session.deleteTournamentPlayers,
+                 t_id)
+    timings.time('deleteTournament', session.deleteTournament, t_id)
+    return timings
+
+
+def planningTime(c, sql):
+    """Returns the server's planning time of sql in milliseconds, running
+    it under EXPLAIN ANALYZE in a savepoint that is rolled back."""
+    c.execute("SAVEPOINT planning")
+    try:
+        c.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + sql)
+        return c.fetchone()[0][0]['Planning Time']
+    finally:
+        c.execute("ROLLBACK TO SAVEPOINT planning")
+
+
+def planCounts(c):
+    """Returns {statement name: [generic plans, custom plans]} of the
+    connection's prepared statements, or None before PostgreSQL 14."""
+    c.execute("SAVEPOINT planning")
+    try:
+        c.execute("""SELECT name, generic_plans, custom_plans
+                     FROM pg_prepared_statements""")
+        return dict((row[0], list(row[1:])) for row in c.fetchall())
+    except psycopg2.Error:
+        c.execute("ROLLBACK TO SAVEPOINT planning")
+        return None
+
+
+def benchPlanning(database_name, size, rounds, samples, rng):
+    """Times the hot-path calls on a size-player tournament with plain and
+    with prepared statements; returns {mode: {'operations': ...,
+    'planning_ms': ...}} for the modes 'plain' and 'prepared', with the
+    generic and custom plan counts of the prepared statements on the
+    connection planning was measured on."""
+    session = tournament.TournamentSession(ConnectionPool(database_name))
+    t_id = session.registerTournament("Planning {}".format(size))
+    results = {}
+    try:
+        session.registerPlayers(t_id, ["Player {}".format(i)
+                                       for i in range(size)])
+        for round in range(rounds):
+            pairings = session.swissPairings(t_id)
+            session.reportMatches(t_id, [(p[0], p[2], rng.random() < 0.05)
+                                         for p in pairings])
+
+        for mode in ('plain', 'prepared'):
+            tournament.PREPARE_STATEMENTS = mode == 'prepared'
+            timings = Timings()
+            pairings = timings.time('swissPairings', session.swissPairings,
+                                    t_id)
+            for id1, name1, id2, name2 in pairings[:samples]:
+                timings.time('reportMatch', session.reportMatch, t_id,
+                             id1, id2, rng.random() < 0.05)
+            for i in range(samples):
+                timings.time('playerStandings', session.playerStandings,
+                             t_id)
+
+            planning = {}
+            with session.pool.connection() as db:
+                c = db.cursor()
+                for statement in (tournament.STANDINGS,
+                                  tournament.LOCKED_SNAPSHOT):
+                    params = {'t': t_id}
+                    if mode == 'prepared':
+                        # Past the first few custom plans to the cached one
+                        for i in range(6):
+                            session._run(c, statement, params)
+                        sql = c.mogrify(statement.execute, [t_id])
+                    else:
+                        sql = c.mogrify(statement.query, params)
+                    if isinstance(sql, bytes) and not isinstance(sql, str):
+                        sql = sql.decode('utf-8')
+                    planning[statement.name] = planningTime(c, sql)
+                plans = planCounts(c) if mode == 'prepared' else None
+                db.rollback()
+            results[mode] = {'operations': timings.summary(),
+                             'planning_ms': planning}
+            if plans is not None:
+                # Whether the server kept re-planning (custom plans) or
+                # settled on the cached generic plan
+                results[mode]['plans'] = plans
+    finally:
+        tournament.PREPARE_STATEMENTS = True
+        session.deleteTournamentMatches(t_id)
+        session.deleteTournamentPlayers(t_id)
+        session.deleteTournament(t_id)
+        session.close()
+    return results
+
+
+def run(database_name, sizes, rounds, samples, seed, planning=None):
+    """Benchmarks each size in turn, then planning at that size if given;
+    returns the JSON-ready report."""
+    session = tournament.TournamentSession(
+        ConnectionPool(database_name))
+    rng = random.Random(seed)
+    report = {'database': database_name,
+              'rounds': rounds,
+              'samples': samples,
+              'seed': seed,
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': {}}
+    try:
+        for size in sizes:
+            start = timer()
+            timings = benchTournament(session, size, rounds, samples, rng)
+            report['results'][str(size)] = {
+                'players': size,
+                'wall_s': timer() - start,
+                'operations': timings.summary()}
+            sys.stderr.write("{} players: {:.1f}s\n".format(
+                size, report['results'][str(size)]['wall_s']))
+    finally:
+        session.close()
+
+    if planning:
+        start = timer()
+        report['planning'] = benchPlanning(database_name, planning, rounds,
+                                           samples, rng)
+        report['planning']['players'] = planning
+        sys.stderr.write("{} players, plain and prepared: {:.1f}s\n".format(
+            planning, timer() - start))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tournament API at realistic scale.")
+    parser.add_argument("--database", default="tournament",
+                        help="database name (default: tournament)")
+    parser.add_argument("--sizes", default="100,1000,10000,100000",
+                        help="comma separated tournament sizes")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="Swiss rounds played per tournament")
+    parser.add_argument("--samples", type=int, default=200,
+                        help="single-row calls timed per operation and round")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed for match results")
+    parser.add_argument("--planning", type=int, metavar="SIZE",
+                        help="also compare plain and prepared statements "
+                             "on a SIZE-player tournament")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = run(args.database, sizes, args.rounds, args.samples, args.seed,
+                 args.planning)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
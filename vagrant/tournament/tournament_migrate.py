@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# tournament_migrate.py -- bring an existing tournament database up to date
+#
+# Applies the numbered SQL files in migrations/ that the database has not
+# seen yet, each in its own transaction, and records them in the
+# schema_migrations table. A database created from tournament.sql starts
+# with every migration already recorded.
+#
+# Usage: python tournament_migrate.py [--database NAME] [--partition-matches]
+#
+
+import argparse
+import glob
+import os
+
+import psycopg2
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "migrations")
+
+# Optional layouts, applied only when asked for on the command line
+PARTITION_MATCHES = "optional/partition_matches"
+
+
+def readMigration(name):
+    with open(os.path.join(MIGRATIONS_DIR, name + ".sql")) as f:
+        return f.read()
+
+
+def availableMigrations():
+    """Returns the names of the numbered migrations, oldest first."""
+    paths = glob.glob(os.path.join(MIGRATIONS_DIR, "[0-9]*.sql"))
+    return sorted(os.path.splitext(os.path.basename(p))[0] for p in paths)
+
+
+def appliedMigrations(db):
+    """Returns the set of migration names recorded in the database."""
+    c = db.cursor()
+    c.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                     version TEXT PRIMARY KEY,
+                     applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP )""")
+    c.execute("SELECT version FROM schema_migrations")
+    applied = set(row[0] for row in c.fetchall())
+    db.commit()
+    return applied
+
+
+def applyMigration(db, name):
+    """Runs one migration and records it, all in one transaction."""
+    c = db.cursor()
+    try:
+        c.execute(readMigration(name))
+        c.execute("INSERT INTO schema_migrations (version) VALUES (%s)",
+                  (name,))
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+
+def migrate(database_name="tournament", partition_matches=False):
+    """Applies every pending migration to a database.
+
+    Args:
+        database_name: name of the database to migrate
+        partition_matches: also switch matches to the list-partitioned
+            layout in migrations/optional/partition_matches.sql
+
+    Returns:
+        A list of the names of the migrations applied
+    """
+    db = psycopg2.connect("dbname={}".format(database_name))
+    try:
+        applied = appliedMigrations(db)
+        pending = [name for name in availableMigrations()
+                   if name not in applied]
+        if partition_matches and PARTITION_MATCHES not in applied:
+            pending.append(PARTITION_MATCHES)
+        for name in pending:
+            print("Applying {}...".format(name))
+            applyMigration(db, name)
+        return pending
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Bring a tournament database up to date.")
+    parser.add_argument("--database", default="tournament",
+                        help="database name (default: tournament)")
+    parser.add_argument("--partition-matches", action="store_true",
+                        help="list-partition the matches table by "
+                             "tournament (PostgreSQL 11+)")
+    args = parser.parse_args()
+
+    if not migrate(args.database, args.partition_matches):
+        print("Database is up to date.")
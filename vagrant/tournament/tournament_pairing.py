@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# tournament_pairing.py -- Swiss pairing engine, independent of the database
+#
+# Works on a compact snapshot of a tournament: player ids in standings order,
+# the set of opponents each player has already faced, and bye counts.
+#
+
+import multiprocessing
+from collections import deque
+
+
+def chooseBye(ranked, byes):
+    """Returns the player who sits out the round when there is an odd number.
+
+    The bye goes to the highest ranked player who has not had one yet. If
+    everyone has had a bye, it goes to the highest ranked player among those
+    with the fewest.
+
+    Args:
+        ranked: player ids in standings order, first place first
+        byes: a dict of player id to number of byes received
+    """
+    fewest = min(byes.get(id, 0) for id in ranked)
+    for id in ranked:
+        if byes.get(id, 0) == fewest:
+            return id
+
+
+def pairPlayers(ranked, opponents):
+    """Pairs an even number of players for the next Swiss round.
+
+    Players are taken in standings order, so players on the same score sit
+    next to each other and each one is paired with the nearest player below
+    them they have not played yet. Players left without a partner that way
+    are then fitted in by re-pairing players around them (see _augment),
+    trying the players nearest them in the standings first; players from
+    higher score groups float down only as far as that takes.
+
+    The result has as few rematches as possible: none if a rematch-free
+    pairing exists, and otherwise the players who cannot avoid one are
+    paired with their neighbours in the standings.
+
+    Args:
+        ranked: player ids in standings order, first place first
+        opponents: a dict of player id to the set of ids already played
+
+    Returns:
+        A list of (id1, id2) tuples, id1 being the higher ranked player
+    """
+    n = len(ranked)
+    if n % 2 != 0:
+        raise ValueError("pairPlayers needs an even number of players.")
+
+    empty = frozenset()
+    played = [opponents.get(id, empty) for id in ranked]
+    mate = [-1] * n
+    for i in range(n):
+        if mate[i] != -1:
+            continue
+        # Nearest unpaired player below ranked[i] who has not met them
+        j = i + 1
+        while j < n and (mate[j] != -1 or ranked[j] in played[i]
+                         or ranked[i] in played[j]):
+            j += 1
+        if j < n:
+            mate[i], mate[j] = j, i
+
+    unpaired = [i for i in range(n) if mate[i] == -1]
+    for i in unpaired:
+        if mate[i] == -1:
+            _augment(ranked, played, mate, unpaired, i)
+
+    # Whoever is still unpaired has played everyone else still unpaired
+    rest = [i for i in range(n) if mate[i] == -1]
+    for i, j in zip(rest[::2], rest[1::2]):
+        mate[i], mate[j] = j, i
+    return [(ranked[i], ranked[mate[i]]) for i in range(n) if i < mate[i]]
+
+
+def _nearest(i, n):
+    """Yields the indexes other than i in [0, n), nearest to i first."""
+    for d in range(1, max(i + 1, n - i)):
+        if i - d >= 0:
+            yield i - d
+        if i + d < n:
+            yield i + d
+
+
+def _augment(ranked, played, mate, unpaired, root):
+    """Pairs the unpaired player root, if it can be, by re-pairing others.
+
+    This is one search of Edmonds' blossom algorithm for an augmenting path:
+    root pairs with some player, whose old partner pairs with another, and
+    so on until the last one pairs with another unpaired player. Every step
+    stays rematch-free, and a failed search means no re-pairing can fit
+    root in. mate (the index of each player's partner, -1 for none) is
+    updated in place.
+
+    Players are tried nearest in the standings first, and every player the
+    search reaches is checked against the (few) unpaired players at once, so
+    in a Swiss round, where most pairs are still possible, the path found is
+    short and local.
+
+    Returns:
+        Whether root was paired
+    """
+    n = len(ranked)
+    base = list(range(n))
+    parent = [-1] * n
+    outer = [False] * n
+    outer[root] = True
+    queue = deque([root])
+
+    def meets(i, j):
+        return ranked[j] not in played[i] and ranked[i] not in played[j]
+
+    def pairUnpaired(v):
+        # An unpaired player v meets ends the path
+        for j in unpaired:
+            if j != root and mate[j] == -1 and parent[j] == -1 \
+                    and meets(v, j):
+                parent[j] = v
+                return j
+        return -1
+
+    def commonBase(a, b):
+        seen = set()
+        while True:
+            a = base[a]
+            seen.add(a)
+            if mate[a] == -1:
+                break
+            a = parent[mate[a]]
+        while True:
+            b = base[b]
+            if b in seen:
+                return b
+            b = parent[mate[b]]
+
+    def markPath(v, b, child, blossom):
+        while base[v] != b:
+            blossom.add(base[v])
+            blossom.add(base[mate[v]])
+            parent[v] = child
+            child = mate[v]
+            v = parent[mate[v]]
+
+    end = -1
+    while queue and end == -1:
+        v = queue.popleft()
+        for to in _nearest(v, n):
+            if base[v] == base[to] or mate[v] == to or not meets(v, to):
+                continue
+            if to == root or (mate[to] != -1 and parent[mate[to]] != -1):
+                # An odd cycle: contract it into a blossom around b
+                b = commonBase(v, to)
+                blossom = set()
+                markPath(v, b, to, blossom)
+                markPath(to, b, v, blossom)
+                for i in range(n):
+                    if base[i] in blossom:
+                        base[i] = b
+                        if not outer[i]:
+                            outer[i] = True
+                            queue.append(i)
+                            end = pairUnpaired(i)
+                            if end != -1:
+                                break
+            elif parent[to] == -1:
+                parent[to] = v
+                if mate[to] == -1:
+                    end = to
+                else:
+                    outer[mate[to]] = True
+                    queue.append(mate[to])
+                    end = pairUnpaired(mate[to])
+            if end != -1:
+                break
+    if end == -1:
+        return False
+
+    # Flip the pairs along the path back to root
+    v = end
+    while v != -1:
+        pv = parent[v]
+        ppv = mate[pv]
+        mate[v], mate[pv] = pv, v
+        v = ppv
+    return True
+
+
+def pairRound(ranked, opponents, byes):
+    """Pairs a whole round, assigning a bye first if the count is odd.
+
+    Args:
+        ranked: player ids in standings order, first place first
+        opponents: a dict of player id to the set of ids already played
+        byes: a dict of player id to number of byes received
+
+    Returns:
+        A tuple (pairs, bye): the list of (id1, id2) pairs and the id of the
+        player given a bye, or None if nobody sits out
+    """
+    bye = None
+    if len(ranked) % 2 != 0:
+        bye = chooseBye(ranked, byes)
+        ranked = [id for id in ranked if id != bye]
+    return pairPlayers(ranked, opponents), bye
+
+
+def _pairSnapshot(snapshot):
+    return pairRound(*snapshot)
+
+
+def pairRounds(snapshots, processes=None):
+    """Pairs the next round of several tournaments, in parallel.
+
+    Tournaments are handed to a pool of worker processes largest first, so
+    the wall time approaches that of pairing the largest one alone.
+
+    Args:
+        snapshots: a list of (ranked, opponents, byes) tuples, as pairRound
+            takes them
+        processes: number of worker processes, None for one per CPU; with
+            one, or a single snapshot, everything is paired in this process
+
+    Returns:
+        A list of the (pairs, bye) results of pairRound, in snapshots order
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(snapshots) < 2:
+        return [pairRound(*snapshot) for snapshot in snapshots]
+
+    order = sorted(range(len(snapshots)),
+                   key=lambda i: len(snapshots[i][0]), reverse=True)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_pairSnapshot, [snapshots[i] for i in order],
+                           chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    paired = [None] * len(snapshots)
+    for i, result in zip(order, results):
+        paired[i] = result
+    return paired
+
+
+def opponentSets(matches):
+    """Builds the opponents dict pairPlayers expects from (winner, loser)
+    rows."""
+    opponents = {}
+    for winner, loser in matches:
+        opponents.setdefault(winner, set()).add(loser)
+        opponents.setdefault(loser, set()).add(winner)
+    return opponents
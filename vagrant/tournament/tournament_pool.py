@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# tournament_pool.py -- bounded pool of connections to the tournament database
+#
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that remembers the names of the statements prepared on
+    it, as prepared statements last as long as the connection does."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool(object):
+    """A bounded, health-checked pool of psycopg2 connections.
+
+    At most maxconn connections are open at any time; once they are all
+    checked out, getconn() blocks until one is returned. Connections that sat
+    idle for longer than check_after seconds are pinged before being handed
+    out again, so a connection dropped by the server is replaced rather than
+    failing the caller's first query.
+
+    Args:
+        database_name: name of the database to connect to
+        minconn: number of connections opened up front
+        maxconn: upper bound on open connections (idle and checked out)
+        timeout: seconds to wait for a free connection, None waits forever
+        check_after: idle seconds after which a connection is pinged
+    """
+
+    def __init__(self, database_name="tournament", minconn=1, maxconn=10,
+                 timeout=None, check_after=30):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError("Pool size must satisfy 0 <= minconn <= maxconn "
+                             "and maxconn >= 1.")
+        self.dsn = "dbname={}".format(database_name)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # LIFO of (connection, time it was returned)
+        self._size = 0   # open connections, idle or checked out
+        self._pid = os.getpid()
+
+        for i in range(minconn):
+            self._size += 1
+            self._idle.append((self._open(), time.time()))
+
+    def _open(self):
+        return psycopg2.connect(self.dsn,
+                                connection_factory=PreparingConnection)
+
+    def _checkFork(self):
+        # Connections inherited across fork() belong to the parent process;
+        # forget them (without closing, which would hang up on the parent).
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._size = 0
+
+    def _reserve(self, deadline):
+        """Returns an idle (connection, since) pair, or (None, None) after
+        reserving a slot for a new connection. Must hold self._cond."""
+        while True:
+            self._checkFork()
+            if self._idle:
+                return self._idle.pop()
+            if self._size < self.maxconn:
+                self._size += 1
+                return None, None
+            if deadline is None:
+                self._cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError("connection pool exhausted")
+                self._cond.wait(remaining)
+
+    def _release(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, since):
+        if conn.closed:
+            return False
+        if time.time() - since < self.check_after:
+            return True
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1")
+            c.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Checks a connection out of the pool, opening one if needed."""
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+
+        while True:
+            with self._cond:
+                conn, since = self._reserve(deadline)
+            if conn is None:
+                try:
+                    return self._open()
+                except:
+                    self._release()
+                    raise
+            if self._healthy(conn, since):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool.
+
+        Any transaction left open is rolled back. Broken connections, or any
+        connection when close is true, are closed instead of being kept.
+        """
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and returns it."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Closes every idle connection in the pool."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, since in idle:
+            self._discard(conn)
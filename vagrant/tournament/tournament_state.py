@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# tournament_state.py -- a tournament held in memory, for simulating rounds
+#
+# A TournamentState is loaded from the database once and then plays out
+# results and pairings without touching it again, so a Monte-Carlo
+# projection can replay thousands of simulated rounds. Every player gets a
+# slot index, each standings column is an array.array indexed by slot and
+# the matches are three parallel arrays, so copying a state to branch a
+# simulation copies a handful of flat buffers rather than rows of objects.
+#
+
+from array import array
+
+import tournament
+
+from tournament_pairing import pairRound
+from tournament_tiebreaks import Tiebreaks
+
+
+class TournamentState(object):
+    """Players, results and standings of one tournament, in memory.
+
+    Args:
+        players: (id, name, byes) rows, one per player
+        matches: an iterable of (winner, loser, draw) rows, oldest first
+    """
+
+    def __init__(self, players, matches=()):
+        players = list(players)
+        self.ids = array('l', [row[0] for row in players])
+        self.names = [row[1] for row in players]
+        self.slots = dict((id, s) for s, id in enumerate(self.ids))
+        n = len(players)
+        self.wins = array('l', [0]) * n
+        self.ties = array('l', [0]) * n
+        self.matches = array('l', [0]) * n
+        self.omw = array('l', [0]) * n
+        self.byes = array('l', [row[2] for row in players])
+        # The match log, by slot: winner, loser and whether it was a draw
+        self.winners = array('l')
+        self.losers = array('l')
+        self.draws = array('b')
+        self.applyResults(matches)
+
+    @classmethod
+    def load(cls, t_id, session=None):
+        """Loads a tournament's players and matches with two queries.
+
+        Args:
+            t_id: the tournament's id
+            session: a TournamentSession, the default session if omitted
+        """
+        if session is None:
+            session = tournament.getSession()
+        with session.cursor() as c:
+            query = """SELECT id, name, byes FROM players
+                       WHERE tournament = %s ORDER BY id"""
+            c.execute(query, (t_id,))
+            players = c.fetchall()
+            query = """SELECT winner, loser, draw FROM matches
+                       WHERE tournament = %s ORDER BY id"""
+            c.execute(query, (t_id,))
+            matches = c.fetchall()
+        return cls(players, matches)
+
+    def copy(self):
+        """Returns an independent copy, for branching a simulation. The
+        players are shared; the results and standings are copied."""
+        state = TournamentState.__new__(TournamentState)
+        state.ids = self.ids
+        state.names = self.names
+        state.slots = self.slots
+        for column in ('wins', 'ties', 'matches', 'omw', 'byes',
+                       'winners', 'losers', 'draws'):
+            setattr(state, column, getattr(self, column)[:])
+        return state
+
+    def applyResults(self, results):
+        """Records match outcomes, a round or more at a time.
+
+        The win, tie and match counts are updated per result; omw (total
+        wins of the opponents faced) is then recomputed for everyone in one
+        pass over the match log, as one more win for a player raises the
+        omw of every opponent they have ever had.
+
+        Args:
+            results: an iterable of (winner, loser) or (winner, loser, draw)
+                rows of player ids
+
+        Raises:
+            ValueError: a result names a player not in the tournament
+        """
+        slots = self.slots
+        wins, ties, matches = self.wins, self.ties, self.matches
+        winners, losers, draws = self.winners, self.losers, self.draws
+        applied = False
+        for result in results:
+            draw = bool(result[2]) if len(result) > 2 else False
+            try:
+                w, l = slots[result[0]], slots[result[1]]
+            except KeyError as e:
+                raise ValueError("Player {} is not in this tournament."
+                                 .format(e.args[0]))
+            winners.append(w)
+            losers.append(l)
+            draws.append(draw)
+            matches[w] += 1
+            matches[l] += 1
+            if draw:
+                ties[w] += 1
+                ties[l] += 1
+            else:
+                wins[w] += 1
+            applied = True
+        if applied:
+            self._recomputeOmw()
+
+    def _recomputeOmw(self):
+        wins = self.wins
+        omw = array('l', [0]) * len(wins)
+        for w, l in zip(self.winners, self.losers):
+            omw[w] += wins[l]
+            omw[l] += wins[w]
+        self.omw = omw
+
+    def _rankedSlots(self, by_matches=True):
+        """Slots best first: by wins, ties and omw, then (as player_standings
+        does, but pairing does not) by matches, and the lowest id on a full
+        tie."""
+        wins, ties, omw, matches, ids = (self.wins, self.ties, self.omw,
+                                         self.matches, self.ids)
+        if not by_matches:
+            return sorted(range(len(ids)),
+                          key=lambda s: (-wins[s], -ties[s], -omw[s], ids[s]))
+        return sorted(range(len(ids)),
+                      key=lambda s: (-wins[s], -ties[s], -omw[s],
+                                     -matches[s], ids[s]))
+
+    def standings(self, tiebreaks=None):
+        """Returns the standings as playerStandings does: (id, name, wins,
+        ties, matches, omw, byes) tuples, first place first, ordered by a
+        chain of tournament_tiebreaks measures if one is given."""
+        rows = [(self.ids[s], self.names[s], self.wins[s], self.ties[s],
+                 self.matches[s], self.omw[s], self.byes[s])
+                for s in self._rankedSlots()]
+        if not tiebreaks:
+            return rows
+        key = self.tiebreaks().sortKey(tiebreaks)
+        return sorted(rows, key=lambda row: key(row[0]))
+
+    def tiebreaks(self):
+        """Returns the Tiebreaks of the current results."""
+        ids = self.ids
+        matches = [(ids[w], ids[l], bool(d))
+                   for w, l, d in zip(self.winners, self.losers, self.draws)]
+        byes = dict((ids[s], count) for s, count in enumerate(self.byes))
+        return Tiebreaks(ids, matches, byes)
+
+    def pairNextRound(self):
+        """Pairs the next round as swissPairings would, giving any bye.
+
+        Returns:
+            A tuple (pairs, bye): the list of (id1, id2) pairs and the id of
+            the player given a bye, or None if nobody sits out
+        """
+        ids = self.ids
+        opponents = dict((id, set()) for id in ids)
+        for w, l in zip(self.winners, self.losers):
+            opponents[ids[w]].add(ids[l])
+            opponents[ids[l]].add(ids[w])
+        byes = dict((ids[s], count) for s, count in enumerate(self.byes))
+
+        pairs, bye = pairRound([ids[s] for s in self._rankedSlots(False)],
+                               opponents, byes)
+        if bye is not None:
+            self.byes[self.slots[bye]] += 1
+        return pairs, bye
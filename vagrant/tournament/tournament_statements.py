@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# tournament_statements.py -- the hot-path SQL of tournament.py and
+# tournament_async.py, written once
+#
+# Each Statement keeps its query with %(param)s placeholders for psycopg2 and
+# builds the $N form that PREPARE and asyncpg take from it, so the blocking
+# and asyncio APIs always send the same SQL.
+#
+
+
+class Statement(object):
+    """A hot-path query, prepared on each pooled connection the first time
+    it runs there and executed by name from then on, so the server parses
+    and plans it once per connection rather than once per call.
+
+    Args:
+        name: name of the prepared statement
+        query: the SQL, with %(param)s placeholders
+        types: (param, SQL type) pairs, one per placeholder
+    """
+
+    def __init__(self, name, query, types):
+        self.name = name
+        self.query = query
+        self.params = [param for param, type in types]
+        # The same SQL with $N placeholders, cast to their types so that a
+        # driver preparing it unnamed (asyncpg) needs no other declaration
+        numbered = query
+        for i, (param, type) in enumerate(types, 1):
+            numbered = numbered.replace("%({})s".format(param),
+                                        "${}::{}".format(i, type))
+        self.numbered = numbered
+        self.prepare = "PREPARE {} ({}) AS {}".format(
+            name, ", ".join(type for param, type in types), numbered)
+        self.execute = "EXECUTE {} ({})".format(
+            name, ", ".join(["%s"] * len(self.params)))
+
+    def args(self, params):
+        """Returns the values of a dict of params in placeholder order."""
+        return [params[param] for param in self.params]
+
+
+REGISTER_PLAYER = Statement(
+    "register_player",
+    """WITH p AS (INSERT INTO players (name, tournament, byes)
+                 VALUES (%(name)s, %(t)s, 0)
+                 RETURNING id, tournament),
+       s AS (INSERT INTO standings (player, tournament)
+             SELECT id, tournament FROM p)
+       INSERT INTO events (tournament, kind, player)
+       SELECT tournament, 'register', id FROM p""",
+    [('name', 'text'), ('t', 'integer')])
+
+STANDINGS = Statement(
+    "player_standings_by_tournament",
+    """SELECT player, name, wins, ties, matches, omw, byes
+       FROM player_standings WHERE tournament = %(t)s""",
+    [('t', 'integer')])
+
+# The results the tiebreaks of a tournament's standings are computed from
+TOURNAMENT_MATCHES = Statement(
+    "matches_by_tournament",
+    """SELECT winner, loser, draw FROM matches
+       WHERE tournament = %(t)s""",
+    [('t', 'integer')])
+
+# The id of a tournament's open round, which getCurrentPairings checks its
+# cached pairings against
+OPEN_ROUND = Statement(
+    "open_round",
+    "SELECT id FROM rounds WHERE tournament = %(t)s AND NOT completed",
+    [('t', 'integer')])
+
+# Standings best first with each player's opponents, locking the tournament
+LOCKED_SNAPSHOT = Statement(
+    "locked_snapshot",
+    """SELECT s.player, p.name, s.byes,
+           ARRAY(SELECT CASE WHEN m.winner = s.player
+                        THEN m.loser ELSE m.winner END
+                 FROM matches AS m
+                 WHERE m.tournament = s.tournament
+                 AND (m.winner = s.player
+                      OR m.loser = s.player)) AS opponents
+       FROM tournaments AS t
+       JOIN standings AS s ON s.tournament = t.id
+       JOIN players AS p ON p.id = s.player
+       WHERE t.id = %(t)s
+       ORDER BY s.wins DESC, s.ties DESC, s.omw DESC, s.player
+       FOR UPDATE OF t""",
+    [('t', 'integer')])
+
+ASSIGN_BYE = Statement(
+    "assign_bye",
+    """WITH p AS (UPDATE players SET byes = byes + 1
+                 WHERE id = %(p)s AND tournament = %(t)s
+                 RETURNING id, tournament),
+       s AS (UPDATE standings SET byes = standings.byes + 1
+             FROM p WHERE standings.player = p.id)
+       INSERT INTO events (tournament, kind, player)
+       SELECT tournament, 'bye', id FROM p""",
+    [('p', 'integer'), ('t', 'integer')])
+
+# Taken first by everything that updates standings incrementally, so that
+# the results of one tournament are applied one at a time: each update adds
+# to counts another transaction may be changing (a player's wins feed every
+# opponent's omw), and touches opponents' rows in no fixed order. Everything
+# that logs events takes it too (or LOCKED_SNAPSHOT's), so a snapshot under
+# it sees every event numbered below the latest one.
+LOCK_TOURNAMENT = Statement(
+    "lock_tournament",
+    "SELECT id FROM tournaments WHERE id = %(t)s FOR UPDATE",
+    [('t', 'integer')])
+
+# reportMatch: the match and its event, then both players' standings, then
+# (for a win) the omw of everyone the winner has played
+REPORT_MATCH = Statement(
+    "report_match",
+    """WITH m AS (INSERT INTO matches (tournament, winner, loser, draw)
+                 VALUES (%(t)s, %(w)s, %(l)s, %(d)s)
+                 RETURNING id)
+       INSERT INTO events (tournament, kind, player, opponent, draw, match)
+       SELECT %(t)s, 'result', %(w)s, %(l)s, %(d)s, id FROM m
+       RETURNING match""",
+    [('t', 'integer'), ('w', 'integer'), ('l', 'integer'),
+     ('d', 'boolean')])
+
+REPORT_MATCH_STANDINGS = Statement(
+    "report_match_standings",
+    """UPDATE standings AS s
+       SET matches = s.matches + 1,
+           wins = s.wins + CASE WHEN %(d)s THEN 0
+               WHEN s.player = %(w)s THEN 1 ELSE 0 END,
+           ties = s.ties + CASE WHEN %(d)s THEN 1 ELSE 0 END,
+           points = s.points + CASE WHEN %(d)s THEN 1
+               WHEN s.player = %(w)s THEN 3 ELSE 0 END,
+           omw = s.omw + o.wins
+       FROM standings AS o
+       WHERE (s.player = %(w)s AND o.player = %(l)s)
+       OR (s.player = %(l)s AND o.player = %(w)s)""",
+    [('w', 'integer'), ('l', 'integer'), ('d', 'boolean')])
+
+REPORT_MATCH_OMW = Statement(
+    "report_match_omw",
+    """UPDATE standings AS s SET omw = s.omw + o.n
+       FROM (SELECT CASE WHEN winner = %(w)s
+                    THEN loser ELSE winner END AS player,
+                 COUNT(*) AS n
+             FROM matches
+             WHERE tournament = %(t)s
+             AND (winner = %(w)s OR loser = %(w)s)
+             GROUP BY 1) AS o
+       WHERE s.player = o.player""",
+    [('t', 'integer'), ('w', 'integer')])
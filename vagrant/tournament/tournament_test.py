@@ -3,6 +3,13 @@
 # Test cases for tournament.py
 
 from tournament import *
+from tournament_pairing import opponentSets, pairPlayers
+from tournament_pool import ConnectionPool, PoolError
+from tournament_state import TournamentState
+from tournament_statements import LOCK_TOURNAMENT, REPORT_MATCH
+from tournament_tiebreaks import Tiebreaks
+import threading
+import tournament_tracing
 
 
 def deleteAll():
@@ -13,12 +20,12 @@ def deleteAll():
 
 def testDeleteMatches():
     deleteMatches()
-    print "1. Old matches can be deleted."
+    print("1. Old matches can be deleted.")
 
 
 def testDelete():
     deleteAll()
-    print "2. Player records can be deleted. Tournaments can be deleted."
+    print("2. Player records can be deleted. Tournaments can be deleted.")
 
 
 def testCount():
@@ -29,7 +36,7 @@ def testCount():
             "countPlayers() should return numeric zero, not string '0'.")
     if c != 0:
         raise ValueError("After deleting, countPlayers should return zero.")
-    print "3. After deleting, countPlayers() returns zero."
+    print("3. After deleting, countPlayers() returns zero.")
 
 
 def testRegister():
@@ -40,7 +47,7 @@ def testRegister():
     if c != 1:
         raise ValueError(
             "After one player registers, countPlayers() should be 1.")
-    print "4. After registering a player, countPlayers() returns 1."
+    print("4. After registering a player, countPlayers() returns 1.")
 
 
 def testRegisterCountDelete():
@@ -58,7 +65,7 @@ def testRegisterCountDelete():
     c = countPlayers()
     if c != 0:
         raise ValueError("After deleting, countPlayers should return zero.")
-    print "5. Players can be registered and deleted."
+    print("5. Players can be registered and deleted.")
 
 
 def testTournamentRegisterCountDelete():
@@ -79,7 +86,7 @@ def testTournamentRegisterCountDelete():
     if c != 0:
         raise ValueError("After deleting, countTournamentPlayers "
                          "should return zero.")
-    print "5a. Tournament Players can be registered and deleted."
+    print("5a. Tournament Players can be registered and deleted.")
 
 
 def testStandingsBeforeMatches():
@@ -105,7 +112,7 @@ def testStandingsBeforeMatches():
     if set([name1, name2]) != set(["Melpomene Murray", "Randy Schwartz"]):
         raise ValueError("Registered players' names should appear in standings, "
                          "even if they have no matches played.")
-    print "6. Newly registered players appear in the standings with no matches."
+    print("6. Newly registered players appear in the standings with no matches.")
 
 
 def testReportMatches():
@@ -129,7 +136,7 @@ def testReportMatches():
             raise ValueError("Each match winner should have one win.")
         elif i in (id2, id4) and w != 0:
             raise ValueError("Each match loser should have zero wins.")
-    print "7. After a match, players have updated standings."
+    print("7. After a match, players have updated standings.")
 
 
 def testReportTieMatches():
@@ -153,7 +160,7 @@ def testReportTieMatches():
             raise ValueError("Player two should have zero wins.")
         if i in (id3, id4) and t != 1:
             raise ValueError("Player three and four should have one tie each.")
-    print "7a. After a match, and a tie match, players have updated standings."
+    print("7a. After a match, and a tie match, players have updated standings.")
 
 
 def testPlayerStandingsOmw():
@@ -199,7 +206,7 @@ def testPlayerStandingsOmw():
         set(["Boots O'Neal", "Bruno Walton", "Cathy Burton"])
     ):
         raise ValueError("Player with better OMW not listed in order")
-    print "7b. Players with same scores listed in order by opponent match wins."
+    print("7b. Players with same scores listed in order by opponent match wins.")
 
 
 def testPairings():
@@ -223,7 +230,7 @@ def testPairings():
     if correct_pairs != actual_pairs:
         raise ValueError(
             "After one match, players with one win should be paired.")
-    print "8. After one match, players with one win are paired."
+    print("8. After one match, players with one win are paired.")
 
 
 def testBye():
@@ -276,7 +283,7 @@ def testBye():
         raise ValueError("Should have even players. Expecting 2, not 3.")
     elif "Applejack" in set([p_name1, p_name2]):
         raise ValueError("Player assigned bye should not in player list.")
-    print "8a. Only an even number of players are allowed in pairings."
+    print("8a. Only an even number of players are allowed in pairings.")
 
 
 def testPairingsAndBye():
@@ -306,7 +313,437 @@ def testPairingsAndBye():
             raise ValueError("After one match, byed player should not be paired.")
             break
 
-    print "8b. After one match, byed player excluded. Pairings are good."
+    print("8b. After one match, byed player excluded. Pairings are good.")
+
+
+def testConnectionPool():
+    pool = ConnectionPool(maxconn=1, timeout=0.1)
+    session = TournamentSession(pool)
+    session.deleteMatches()
+    session.countPlayers()
+    with pool.connection():
+        try:
+            pool.getconn()
+        except PoolError:
+            pass
+        else:
+            raise ValueError("A full pool should not hand out more than "
+                             "maxconn connections.")
+    session.countPlayers()
+    session.close()
+    print("9. Sessions reuse a bounded pool of connections.")
+
+
+def testBulkRegisterAndReport():
+    deleteAll()
+    tournament = registerTournament("Open")
+    names = ["Player %d" % i for i in range(2500)]
+    ids = registerPlayers(tournament, names)
+    if len(ids) != len(names):
+        raise ValueError("registerPlayers should return one id per name.")
+    registered = dict((row[0], row[1]) for row in
+                      getTournamentPlayers(tournament))
+    if [registered[i] for i in ids] != names:
+        raise ValueError("registerPlayers should return ids in input order.")
+    results = [(ids[i], ids[i + 1]) for i in range(0, len(ids) - 2, 2)]
+    results.append((ids[-2], ids[-1], True))
+    match_ids = reportMatches(tournament, results)
+    if len(match_ids) != len(results):
+        raise ValueError("reportMatches should return one id per result.")
+    standings = dict((row[0], row) for row in playerStandings(tournament))
+    if standings[ids[0]][2] != 1 or standings[ids[1]][2] != 0:
+        raise ValueError("Bulk reported winners should have one win.")
+    if standings[ids[-1]][3] != 1 or standings[ids[-2]][3] != 1:
+        raise ValueError("Bulk reported draws should count as ties.")
+    print("10. Players and matches can be registered and reported in bulk.")
+
+
+def testStandingsRebuild():
+    deleteAll()
+    tournament = registerTournament("Fun League")
+    [id1, id2, id3, id4] = registerPlayers(
+        tournament, ["Bruno Walton", "Boots O'Neal", "Cathy Burton",
+                     "Diane Grant"])
+    reportMatch(tournament, id1, id2)
+    reportMatch(tournament, id3, id4)
+    reportMatch(tournament, id1, id3)
+    reportMatch(tournament, id2, id4, True)
+    standings = playerStandings(tournament)
+    omws = dict((row[0], row[5]) for row in standings)
+    # Bruno faced Boots (0 wins) and Cathy (1); Cathy faced Bruno (2)
+    if omws[id1] != 1 or omws[id4] != 1 or omws[id3] != 2:
+        raise ValueError("omw should total the wins of every opponent faced.")
+    rebuildStandings(tournament)
+    if set(playerStandings(tournament)) != set(standings):
+        raise ValueError("Rebuilt standings should match incremental ones.")
+    print("11. Incrementally maintained standings match a full rebuild.")
+
+
+def testPairingsAvoidRematches():
+    deleteAll()
+    tournament = registerTournament("Fun League")
+    [id1, id2, id3, id4] = registerPlayers(
+        tournament, ["Twilight Sparkle", "Fluttershy", "Applejack",
+                     "Pinkie Pie"])
+    reportMatches(tournament, [(id1, id2), (id3, id4)])
+    reportMatches(tournament, [(id1, id3), (id2, id4)])
+    # Adjacent pairing would now repeat both first round matches
+    pairings = swissPairings(tournament)
+    actual_pairs = set(frozenset([p[0], p[2]]) for p in pairings)
+    if actual_pairs != set([frozenset([id1, id4]), frozenset([id2, id3])]):
+        raise ValueError("swissPairings should avoid rematches when it can.")
+
+    # Everyone has met: fall back to pairing neighbours in the standings
+    everyone = opponentSets([(1, 2), (3, 4), (1, 3), (2, 4), (1, 4), (2, 3)])
+    if pairPlayers([1, 2, 3, 4], everyone) != [(1, 2), (3, 4)]:
+        raise ValueError("pairPlayers should fall back to adjacent pairs.")
+
+    # The bottom eight have all met, so each must float up to the top eight
+    bottom = range(9, 17)
+    played = opponentSets([(a, b) for a in bottom for b in bottom if a < b])
+    pairs = pairPlayers(list(range(1, 17)), played)
+    if any(id2 in played.get(id1, ()) for id1, id2 in pairs):
+        raise ValueError("pairPlayers should find a rematch-free pairing "
+                         "whenever there is one.")
+
+    # One rematch is unavoidable here, but pairing 1 and 5 first costs two
+    played = opponentSets([(1, 2), (1, 3), (1, 4), (2, 3), (2, 4), (2, 6),
+                           (3, 4), (3, 6), (4, 6)])
+    pairs = pairPlayers([1, 2, 3, 4, 5, 6], played)
+    if sum(id2 in played[id1] for id1, id2 in pairs) != 1:
+        raise ValueError("pairPlayers should keep rematches to a minimum.")
+    print("12. Pairings avoid rematches, falling back when they cannot.")
+
+
+def testByeScopedToTournament():
+    deleteAll()
+    tournament_1 = registerTournament("Fun League")
+    tournament_2 = registerTournament("Pro League")
+    [id1, id2, id3] = registerPlayers(
+        tournament_1, ["Twilight Sparkle", "Fluttershy", "Applejack"])
+    [id4, id5] = registerPlayers(tournament_2, ["Pinkie Pie", "Rarity"])
+    # The overall leader plays in the other tournament
+    reportMatch(tournament_2, id4, id5)
+    pairings = swissPairings(tournament_1)
+    if len(pairings) != 1:
+        raise ValueError("For three players, swissPairings should return "
+                         "one pair.")
+    byes = dict((row[0], row[6]) for row in
+                playerStandings(tournament_1) + playerStandings(tournament_2))
+    if byes[id4] != 0 or byes[id5] != 0:
+        raise ValueError("A bye should only go to a player of the tournament "
+                         "being paired.")
+    if sorted(byes[i] for i in (id1, id2, id3)) != [0, 0, 1]:
+        raise ValueError("Exactly one player should be assigned a bye.")
+    print("13. Byes are assigned within the tournament being paired.")
+
+
+def testRounds():
+    deleteAll()
+    tournament = registerTournament("Fun League")
+    [id1, id2, id3, id4] = registerPlayers(
+        tournament, ["Twilight Sparkle", "Fluttershy", "Applejack",
+                     "Pinkie Pie"])
+    if getCurrentPairings(tournament) != []:
+        raise ValueError("There should be no pairings before a round starts.")
+    pairings = startRound(tournament)
+    if len(pairings) != 2 or getCurrentPairings(tournament) != pairings:
+        raise ValueError("getCurrentPairings should return the pairings of "
+                         "the round started.")
+    try:
+        startRound(tournament)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A round should not start before the last one is "
+                         "completed.")
+    reportMatches(tournament, [(p[0], p[2]) for p in pairings])
+    if completeRound(tournament) != 1:
+        raise ValueError("completeRound should return the round number.")
+    if getCurrentPairings(tournament) != []:
+        raise ValueError("Completed rounds should have no current pairings.")
+    first_round = set(frozenset([p[0], p[2]]) for p in pairings)
+    pairings = startRound(tournament)
+    if first_round & set(frozenset([p[0], p[2]]) for p in pairings):
+        raise ValueError("The second round should not repeat any pairing.")
+    other_session = TournamentSession(getSession().pool)
+    if other_session.getCurrentPairings(tournament) != pairings:
+        raise ValueError("Stored pairings should be reloaded from the "
+                         "database.")
+    # Rounds completed and started by one session are seen by the other
+    reportMatches(tournament, [(p[0], p[2]) for p in pairings])
+    completeRound(tournament)
+    if other_session.getCurrentPairings(tournament) != []:
+        raise ValueError("Cached pairings should be dropped once another "
+                         "session completes their round.")
+    pairings = startRound(tournament)
+    if other_session.getCurrentPairings(tournament) != pairings:
+        raise ValueError("A round started by another session should be "
+                         "seen once started.")
+    print("14. Rounds are stored and their pairings served from the cache.")
+
+
+def testTiebreaks():
+    # 1 beats 2, 2 draws with 3, 3 has a bye
+    tiebreaks = Tiebreaks([1, 2, 3], [(1, 2, False), (2, 3, True)], {3: 1})
+    expected = {'score': [1.0, 0.5, 1.5],
+                'match_points': [3, 1, 4],
+                'buchholz': [0.5, 2.5, 0.5],
+                'sonneborn_berger': [0.5, 0.75, 0.25]}
+    for measure, values in expected.items():
+        if [tiebreaks.value(measure, i) for i in (1, 2, 3)] != values:
+            raise ValueError("Wrong {} tiebreak values.".format(measure))
+    # Opponents' match-win percentages are floored at 1/3
+    if abs(tiebreaks.value('omw_pct', 2) - (1 + 2.0 / 3) / 2) > 1e-9:
+        raise ValueError("OMW% should average the opponents' match-win "
+                         "percentages.")
+    if tiebreaks.rank(('score', 'buchholz')) != [3, 1, 2]:
+        raise ValueError("Players should rank by the tiebreak chain.")
+
+    deleteAll()
+    tournament = registerTournament("Fun League")
+    [id1, id2, id3, id4] = registerPlayers(
+        tournament, ["Bruno Walton", "Boots O'Neal", "Cathy Burton",
+                     "Diane Grant"])
+    reportMatches(tournament, [(id1, id2), (id3, id4), (id2, id4)])
+    standings = playerStandings(tournament, ('score', 'sonneborn_berger'))
+    # Three players have one win; only Bruno beat someone who has won since
+    if [row[0] for row in standings] != [id1, id2, id3, id4]:
+        raise ValueError("playerStandings should sort by the tiebreak chain.")
+    print("15. Tiebreaks are computed for the tournament and sort standings.")
+
+
+def testTracing():
+    deleteAll()
+    tournament = registerTournament("Fun League")
+    [id1, id2] = registerPlayers(tournament, ["Bruno Walton", "Boots O'Neal"])
+    events = []
+    tournament_tracing.addHook(events.append)
+    tournament_tracing.explainAfter(0)
+    try:
+        reportMatch(tournament, id1, id2)
+        standings = playerStandings(tournament)
+    finally:
+        tournament_tracing.removeHook(events.append)
+        tournament_tracing.explainAfter(None)
+    calls = [e for e in events if e['event'] == 'call']
+    if [e['call'] for e in calls] != ['reportMatch', 'playerStandings']:
+        raise ValueError("Each API call should report one call event.")
+    queries = [e for e in events if e['event'] == 'query']
+    if not all(e['plan'] and e['sql'] for e in queries):
+        raise ValueError("Slow statements should carry their SQL and plan.")
+    if calls[0]['queries'] != len(queries) - 1:
+        raise ValueError("Call events should count their statements.")
+    if [row[4] for row in standings] != [1, 1]:
+        raise ValueError("Explaining a statement should not repeat it.")
+    print("16. API calls and statements can be traced and explained.")
+
+
+def testPairAll():
+    deleteAll()
+    tournaments = [registerTournament("Side Event {}".format(i))
+                   for i in range(3)]
+    for i, tournament in enumerate(tournaments):
+        registerPlayers(tournament, ["Player {}".format(n)
+                                     for n in range(4 + i)])
+    startRound(tournaments[0])
+    try:
+        pairAll(tournaments)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("pairAll should refuse tournaments with an open "
+                         "round.")
+    if getCurrentPairings(tournaments[1]) != []:
+        raise ValueError("A refused pairAll should not start any round.")
+    completeRound(tournaments[0])
+
+    pairings = pairAll(tournaments, processes=2)
+    for i, tournament in enumerate(tournaments):
+        if len(pairings[tournament]) != (4 + i) // 2:
+            raise ValueError("pairAll should pair every tournament.")
+        if TournamentSession(getSession().pool).getCurrentPairings(
+                tournament) != pairings[tournament]:
+            raise ValueError("pairAll should store each tournament's round.")
+    byes = [row[6] for row in playerStandings(tournaments[1])]
+    if sorted(byes) != [0, 0, 0, 0, 1]:
+        raise ValueError("pairAll should give a bye in odd tournaments.")
+    if pairAll([]) != {}:
+        raise ValueError("pairAll of no tournaments should pair nothing.")
+    print("17. Several tournaments can be paired at once.")
+
+
+def testTournamentState():
+    deleteAll()
+    t = registerTournament("Simulated")
+    registerPlayers(t, ["Player {}".format(n) for n in range(7)])
+    first = [(row[0], row[2]) for row in swissPairings(t)]
+    reportMatches(t, first[:-1] + [first[-1] + (True,)])
+
+    state = TournamentState.load(t)
+    if sorted(state.standings()) != sorted(playerStandings(t)):
+        raise ValueError("A loaded TournamentState should have the same "
+                         "standings as the database.")
+
+    branch = state.copy()
+    pairs, bye = branch.pairNextRound()
+    played = opponentSets(first)
+    for id1, id2 in pairs:
+        if id2 in played.get(id1, ()):
+            raise ValueError("TournamentState should pair without rematches.")
+    branch.applyResults(pairs)
+    if state.standings() == branch.standings() or \
+            sum(row[4] for row in state.standings()) != 6:
+        raise ValueError("A copied TournamentState should change on its own.")
+
+    for id1, id2 in pairs:
+        reportMatch(t, id1, id2)
+    # The database has not seen the simulated round's bye
+    if sorted(row[:6] for row in branch.standings()) != \
+            sorted(row[:6] for row in playerStandings(t)):
+        raise ValueError("TournamentState should update standings as "
+                         "reportMatch does.")
+    computed = branch.tiebreaks()
+    values = [(computed.value('match_points', row[0]),
+               computed.value('buchholz', row[0]))
+              for row in branch.standings(['match_points', 'buchholz'])]
+    if values != sorted(values, reverse=True):
+        raise ValueError("TournamentState should order by tiebreaks.")
+    print("18. A tournament can be simulated in memory.")
+
+
+def testEventLog():
+    deleteAll()
+    t = registerTournament("Logged")
+    registerPlayers(t, ["Player {}".format(n) for n in range(4)])
+    registerPlayer("Latecomer", t)
+    pairings = startRound(t)
+    reportMatch(t, pairings[0][0], pairings[0][2])
+    reportMatch(t, pairings[1][0], pairings[1][2], True)
+    completeRound(t)
+
+    pairings = startRound(t)
+    reportMatch(t, pairings[0][0], pairings[0][2])
+    wrong = reportMatch(t, pairings[1][2], pairings[1][0])
+    if undoMatch(t, wrong) != (pairings[1][2], pairings[1][0], False):
+        raise ValueError("undoMatch should return the result withdrawn.")
+    reportMatch(t, pairings[1][0], pairings[1][2])
+    try:
+        undoMatch(t, wrong)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A match can only be undone once.")
+    expected = sorted(playerStandings(t))
+    rebuildStandings(t)
+    if sorted(playerStandings(t)) != expected:
+        raise ValueError("undoMatch should take the result out of standings.")
+
+    with getSession().cursor() as c:
+        c.execute("""UPDATE standings SET wins = 0, ties = 0, matches = 0,
+                                          points = 0, omw = 0, byes = 0""")
+    # Round 2: a bye, three results and a correction after the snapshot
+    if replayStandings(t) != 5:
+        raise ValueError("Replay should start from the latest snapshot.")
+    if sorted(playerStandings(t)) != expected:
+        raise ValueError("Replaying the event log should restore standings.")
+    print("19. Results can be undone and standings replayed from the log.")
+
+
+def testPreparedStatements():
+    deleteAll()
+    t = registerTournament("Prepared")
+    registerPlayers(t, ["Player {}".format(n) for n in range(4)])
+    session = TournamentSession(ConnectionPool(maxconn=1))
+    try:
+        pairings = session.swissPairings(t)
+        session.reportMatch(t, pairings[0][0], pairings[0][2])
+        session.reportMatch(t, pairings[1][0], pairings[1][2], True)
+        standings = session.playerStandings(t)
+        with session.pool.connection() as db:
+            c = db.cursor()
+            c.execute("SELECT name FROM pg_prepared_statements")
+            prepared = set(row[0] for row in c.fetchall())
+        if prepared != db.prepared or len(prepared) != 6:
+            raise ValueError("Each hot-path statement should be prepared "
+                             "once on the connection.")
+        if session.playerStandings(t) != standings or \
+                sorted(standings) != sorted(playerStandings(t)):
+            raise ValueError("Prepared statements should return what the "
+                             "plain statements do.")
+    finally:
+        session.close()
+    print("20. Hot-path statements are prepared once per connection.")
+
+
+def testConcurrentResults():
+    deleteAll()
+    t = registerTournament("Concurrent")
+    registerPlayers(t, ["Player {}".format(n) for n in range(32)])
+    session = TournamentSession(ConnectionPool(maxconn=16))
+    errors = []
+    try:
+        for round in range(4):
+            # Every result of the round is reported at once
+            start = threading.Event()
+
+            def report(pairing):
+                start.wait()
+                try:
+                    session.reportMatch(t, pairing[0], pairing[2])
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=report, args=(pairing,))
+                       for pairing in session.swissPairings(t)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise ValueError("Concurrent reports should all succeed, "
+                                 "not fail with {!r}.".format(errors[0]))
+        standings = sorted(session.playerStandings(t))
+        session.rebuildStandings(t)
+        if sorted(session.playerStandings(t)) != standings:
+            raise ValueError("Concurrent reports should not lose updates.")
+    finally:
+        session.close()
+    print("21. Results reported at the same time are all counted.")
+
+
+def testSnapshotWaitsForResults():
+    deleteAll()
+    t = registerTournament("Snapshot")
+    ids = registerPlayers(t, ["Player {}".format(n) for n in range(4)])
+    session = TournamentSession(ConnectionPool(maxconn=2))
+    try:
+        # Take a snapshot while a result is being reported, as reportMatch
+        # does, and commit the result only once the snapshot has had time
+        with session.cursor() as c:
+            params = {'t': t, 'w': ids[0], 'l': ids[1], 'd': False}
+            c.execute(LOCK_TOURNAMENT.query, params)
+            c.execute(REPORT_MATCH.query, params)
+            snapshot = threading.Thread(target=session.snapshotStandings,
+                                        args=(t,))
+            snapshot.start()
+            snapshot.join(0.5)
+            if not snapshot.is_alive():
+                raise ValueError("A snapshot should wait for the results "
+                                 "being reported.")
+        snapshot.join()
+        with session.cursor() as c:
+            c.execute("""SELECT (SELECT max(event) FROM snapshots
+                                 WHERE tournament = %(t)s),
+                                (SELECT max(id) FROM events
+                                 WHERE tournament = %(t)s)""", {'t': t})
+            snapshot_event, last_event = c.fetchone()
+        if snapshot_event != last_event:
+            raise ValueError("A snapshot should include every event "
+                             "logged before it.")
+    finally:
+        session.close()
+    print("22. Snapshots wait for results being reported.")
 
 
 if __name__ == '__main__':
@@ -324,4 +761,18 @@ if __name__ == '__main__':
     testPairings()
     testBye()
     testPairingsAndBye()
-    print "Success!  All tests pass!"
+    testConnectionPool()
+    testBulkRegisterAndReport()
+    testStandingsRebuild()
+    testPairingsAvoidRematches()
+    testByeScopedToTournament()
+    testRounds()
+    testTiebreaks()
+    testTracing()
+    testPairAll()
+    testTournamentState()
+    testEventLog()
+    testPreparedStatements()
+    testConcurrentResults()
+    testSnapshotWaitsForResults()
+    print("Success!  All tests pass!")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# tournament_tiebreaks.py -- tiebreak scores for a whole tournament at once
+#
+# Every player gets a slot index and each measure is a list indexed by slot
+# (plain lists index faster than array.array in CPython), so computing all of
+# them takes two passes over the match list: O(players + matches).
+#
+
+# Measures a tiebreak chain can name, highest value ranks first:
+#   score: 1 per win or bye, 0.5 per draw
+#   match_points: 3 per win or bye, 1 per draw
+#   mwp: match-win percentage, match points over 3 per round, at least 1/3
+#   omw_pct: average mwp of the opponents faced (byes excluded)
+#   buchholz: total score of the opponents faced
+#   sonneborn_berger: total score of opponents beaten plus half the score of
+#       opponents drawn with
+MEASURES = ('score', 'match_points', 'mwp', 'omw_pct', 'buchholz',
+            'sonneborn_berger')
+
+MIN_MWP = 1.0 / 3
+
+
+class Tiebreaks(object):
+    """Tiebreak measures of every player in one tournament.
+
+    Args:
+        players: the tournament's player ids
+        matches: an iterable of (winner, loser, draw) rows
+        byes: a dict of player id to number of byes received
+    """
+
+    def __init__(self, players, matches, byes=None):
+        self.players = list(players)
+        self.slots = dict((id, i) for i, id in enumerate(self.players))
+        n = len(self.players)
+        slots = self.slots
+
+        score = [0.0] * n
+        match_points = [0] * n
+        played = [0] * n
+
+        # Pass 1: each player's own results, as slot index pairs
+        results = []
+        for winner, loser, draw in matches:
+            w, l = slots[winner], slots[loser]
+            results.append((w, l, draw))
+            played[w] += 1
+            played[l] += 1
+            if draw:
+                score[w] += 0.5
+                score[l] += 0.5
+                match_points[w] += 1
+                match_points[l] += 1
+            else:
+                score[w] += 1
+                match_points[w] += 3
+
+        # Rounds count byes as well as matches played
+        rounds = list(played)
+        for id, count in (byes or {}).items():
+            s = slots.get(id)
+            if s is not None and count:
+                score[s] += count
+                match_points[s] += 3 * count
+                rounds[s] += count
+
+        mwp = [0.0] * n
+        for s in range(n):
+            if rounds[s]:
+                mwp[s] = max(MIN_MWP, match_points[s] / (3.0 * rounds[s]))
+
+        # Pass 2: sums over each player's opponents
+        omw_pct = [0.0] * n
+        buchholz = [0.0] * n
+        sonneborn_berger = [0.0] * n
+        for w, l, draw in results:
+            omw_pct[w] += mwp[l]
+            omw_pct[l] += mwp[w]
+            buchholz[w] += score[l]
+            buchholz[l] += score[w]
+            if draw:
+                sonneborn_berger[w] += score[l] / 2
+                sonneborn_berger[l] += score[w] / 2
+            else:
+                sonneborn_berger[w] += score[l]
+        for s in range(n):
+            if played[s]:
+                omw_pct[s] /= played[s]
+
+        self.score = score
+        self.match_points = match_points
+        self.mwp = mwp
+        self.omw_pct = omw_pct
+        self.buchholz = buchholz
+        self.sonneborn_berger = sonneborn_berger
+
+    def value(self, measure, id):
+        """Returns one measure (a name from MEASURES) of one player."""
+        return getattr(self, measure)[self.slots[id]]
+
+    def sortKey(self, chain):
+        """Returns a sort key for player ids that orders them by each measure
+        in chain in turn, highest first.
+
+        Raises:
+            ValueError: chain names a measure not in MEASURES
+        """
+        for measure in chain:
+            if measure not in MEASURES:
+                raise ValueError("Unknown tiebreak {!r}; expected one of "
+                                 "{}.".format(measure, ", ".join(MEASURES)))
+        columns = [getattr(self, measure) for measure in chain]
+        slots = self.slots
+
+        def key(id):
+            s = slots[id]
+            return tuple(-column[s] for column in columns)
+        return key
+
+    def rank(self, chain):
+        """Returns the player ids ordered by a tiebreak chain. Players tied on
+        every measure keep the order they were given in."""
+        return sorted(self.players, key=self.sortKey(chain))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# tournament_tracing.py -- optional timing of tournament API calls and SQL
+#
+# Register a hook with addHook() and every TournamentSession call reports an
+# event dict to it:
+#
+#   {'event': 'query', 'call': 'reportMatch', 'sql': ..., 'duration_ms': ...,
+#    'rows': ..., 'plan': [...]}        one per statement; 'plan' holds the
+#                                       EXPLAIN ANALYZE lines of statements
+#                                       slower than the explain threshold
+#   {'event': 'call', 'call': 'reportMatch', 'duration_ms': ...,
+#    'acquire_ms': ..., 'queries': ..., 'rows': ..., 'error': ...}
+#                                       one per API call, acquire_ms being
+#                                       the time spent waiting on the pool
+#
+# logHook sends events to the 'tournament.trace' logger as JSON lines. With
+# no hooks registered, sessions use plain cursors and each API call pays a
+# single list check.
+#
+
+import functools
+import json
+import logging
+import threading
+from timeit import default_timer as timer
+
+import psycopg2
+import psycopg2.extensions
+
+
+# Statements longer than this are truncated in events
+MAX_SQL_LENGTH = 4096
+
+_hooks = []
+_explain_after = None
+_local = threading.local()
+_log = logging.getLogger('tournament.trace')
+
+
+def addHook(hook):
+    """Registers a callable to receive every trace event dict."""
+    _hooks.append(hook)
+
+
+def removeHook(hook):
+    """Unregisters a hook added with addHook."""
+    _hooks.remove(hook)
+
+
+def enabled():
+    """Returns whether any hook is registered."""
+    return bool(_hooks)
+
+
+def explainAfter(milliseconds):
+    """Captures EXPLAIN ANALYZE plans of statements slower than milliseconds.
+
+    The statement is explained inside a savepoint that is rolled back, so
+    explaining writes has no effect. Pass None to stop capturing plans.
+    """
+    global _explain_after
+    _explain_after = milliseconds
+
+
+def emit(event):
+    """Sends an event to every hook. A failing hook is logged, not raised."""
+    for hook in list(_hooks):
+        try:
+            hook(event)
+        except Exception:
+            _log.exception("Trace hook %r failed", hook)
+
+
+def logHook(event):
+    """Hook that logs each event as a JSON line on 'tournament.trace'; query
+    events that captured a plan are logged as warnings."""
+    level = logging.WARNING if event.get('plan') else logging.INFO
+    _log.log(level, json.dumps(event, sort_keys=True))
+
+
+def _current():
+    return getattr(_local, 'call', None)
+
+
+def traced(method):
+    """Decorator for TournamentSession methods: reports a 'call' event per
+    top-level call while any hook is registered."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not _hooks or _current() is not None:
+            return method(*args, **kwargs)
+
+        call = _local.call = {'event': 'call', 'call': method.__name__,
+                              'acquire_ms': 0.0, 'queries': 0, 'rows': 0,
+                              'error': None}
+        start = timer()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            call['error'] = repr(e)
+            raise
+        finally:
+            call['duration_ms'] = (timer() - start) * 1000
+            _local.call = None
+            emit(call)
+    return wrapper
+
+
+def acquired(seconds):
+    """Records time spent waiting for a pooled connection."""
+    call = _current()
+    if call is not None:
+        call['acquire_ms'] += seconds * 1000
+    else:
+        emit({'event': 'acquire', 'duration_ms': seconds * 1000})
+
+
+class TracingCursor(psycopg2.extensions.cursor):
+    """Cursor that reports a 'query' event for every statement it runs."""
+
+    def execute(self, query, vars=None):
+        start = timer()
+        try:
+            return super(TracingCursor, self).execute(query, vars)
+        finally:
+            self._report(timer() - start)
+
+    def _report(self, seconds):
+        sql = self.query
+        if isinstance(sql, bytes) and not isinstance(sql, str):
+            sql = sql.decode('utf-8', 'replace')
+        duration_ms = seconds * 1000
+        event = {'event': 'query', 'sql': (sql or '')[:MAX_SQL_LENGTH],
+                 'duration_ms': duration_ms, 'rows': self.rowcount,
+                 'plan': None}
+
+        call = _current()
+        if call is not None:
+            event['call'] = call['call']
+            call['queries'] += 1
+            call['rows'] += max(self.rowcount, 0)
+
+        if (_explain_after is not None and sql and
+                duration_ms >= _explain_after):
+            event['plan'] = self._explain(sql)
+        emit(event)
+
+    def _explain(self, sql):
+        """Returns the EXPLAIN ANALYZE lines of sql, or None if it cannot be
+        explained (e.g. a SET, or a failed transaction)."""
+        statement = sql.lstrip().split(None, 1)[0].upper()
+        if statement not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE',
+                             'EXECUTE'):
+            return None
+        status = self.connection.get_transaction_status()
+        if status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            return None
+        c = self.connection.cursor()
+        try:
+            c.execute("SAVEPOINT tournament_trace")
+            try:
+                c.execute("EXPLAIN ANALYZE " + sql)
+                return [row[0] for row in c.fetchall()]
+            except psycopg2.Error:
+                return None
+            finally:
+                c.execute("ROLLBACK TO SAVEPOINT tournament_trace")
+        finally:
+            c.close()